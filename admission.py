@@ -0,0 +1,95 @@
+import os
+import asyncio
+from starlette.responses import JSONResponse
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+# Requests processed at the same time, and requests allowed to wait for a slot before new ones get a 429
+MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", 32))
+MAX_QUEUE = int(os.getenv("SERVER_MAX_QUEUE", 64))
+MAX_BODY_BYTES = int(os.getenv("SERVER_MAX_BODY_BYTES", 1024 * 1024))
+# Seconds a rejected client is asked to wait before retrying
+RETRY_AFTER = int(os.getenv("SERVER_RETRY_AFTER", 5))
+
+REJECTED = metrics.Counter("admission_rejected_total", "Requests rejected by the admission control", ["reason"])
+ADMITTED = metrics.Gauge("admission_in_flight", "Requests being processed or waiting for a slot")
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware bounding the work accepted by the server.
+    At most `max_concurrency` requests under `prefix` are processed at once and `max_queue` more wait for a slot;
+    beyond that, requests are rejected right away with 429 and a Retry-After header, so overload shows up as
+    fast rejections rather than a growing pile of pending requests. Bodies larger than `max_body_bytes` are
+    rejected with 413, whether or not a Content-Length is sent. OPTIONS requests, such as CORS preflights, are
+    never limited.
+    Attributes:
+        admitted (int): Requests currently processed or waiting.
+        rejected (int): Requests rejected with 429 since startup.
+    """
+
+    def __init__(self, app, prefix="/process", max_concurrency=MAX_CONCURRENCY, max_queue=MAX_QUEUE,
+                 max_body_bytes=MAX_BODY_BYTES, retry_after=RETRY_AFTER):
+        self.app = app
+        self.prefix = prefix
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_body_bytes = max_body_bytes
+        self.retry_after = retry_after
+        self.admitted = 0
+        self.rejected = 0
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_body_bytes:
+            REJECTED.inc(reason="body_too_large")
+            await self.reject(scope, receive, send, 413, "Request body too large")
+            return
+        if self.admitted >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            REJECTED.inc(reason="busy")
+            await self.reject(scope, receive, send, 429, "Server busy, retry later", {"Retry-After": str(self.retry_after)})
+            return
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        received = 0
+        started = False
+        too_large = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes and not started:
+                    # Answer here, then tell the app the client is gone so it stops reading and never responds
+                    too_large = True
+                    REJECTED.inc(reason="body_too_large")
+                    await self.reject(scope, receive, send, 413, "Request body too large")
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            if too_large:
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        self.admitted += 1
+        ADMITTED.set(self.admitted)
+        try:
+            async with self._slots:
+                await self.app(scope, limited_receive, tracked_send)
+        finally:
+            self.admitted -= 1
+            ADMITTED.set(self.admitted)
+
+    async def reject(self, scope, receive, send, status_code, detail, headers=None):
+        await JSONResponse({"detail": detail}, status_code=status_code, headers=headers)(scope, receive, send)
@@ -2,46 +2,49 @@ import os
 import re
 import uuid
 from summarizer import summarize
-from urllib import request
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup as bs
+from page_context import get_page
+from models import registry
+import metrics
 from elevenlabs import VoiceSettings
 from elevenlabs.client import ElevenLabs
 
 
 load_dotenv()
 VOICE_ID = "pFZP5JQG7iQjIQuC4Bku"
-ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
-if not ELEVENLABS_API_KEY:
-    raise ValueError("ELEVENLABS_API_KEY environment variable not set")
-client = ElevenLabs(
-    api_key=ELEVENLABS_API_KEY,
-)
 
-def load_content(url):
+def load_elevenlabs_client():
+  ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
+  if not ELEVENLABS_API_KEY:
+      raise ValueError("ELEVENLABS_API_KEY environment variable not set")
+  return ElevenLabs(
+      api_key=ELEVENLABS_API_KEY,
+  )
+
+registry.register("elevenlabs", load_elevenlabs_client)
+
+def load_content(url, page=None):
   """
   Loads the content from the given URL, extracts the text from the HTML, and returns the text.
   Args:
     url (str): The URL of the web page to load.
+    page (PageContext, optional): The already fetched page to use.
   Returns:
     str: The extracted text from the web page.
   Description:
-    This function fetches the HTML content from the provided URL, parses it using BeautifulSoup, and extracts all the text within paragraph tags. 
+    This function takes the page from the given PageContext (or fetches it with `get_page`) and extracts all the text within paragraph tags. 
     It concatenates the text from all paragraphs into a single string, removes any non-breaking space characters, and returns the resulting text. 
     If the extracted text is less than 200 characters, it returns a message indicating that the content is too short to summarize.
   """
   print("- Loading and summarizing the article...")
-  html = request.urlopen(url).read().decode('utf8')
-  soupObj = bs(html, "html.parser")
-  paras = soupObj.find_all('p')
-  allPara = " "
-  for para in paras:
-    allPara = allPara + para.text
+  page = page or get_page(url)
+  allPara = " " + "".join(page.paragraphs)
   allPara = re.sub(r'\xa0', '', allPara) 
   if len(allPara) < 200:
     return "Content is too short to summarize. Less than 200 characters."
   return allPara
 
+@metrics.stage("tts")
 def elevenlabs_tts(text):
   """
   Converts the given text to speech using the Eleven Labs Text-to-Speech API and saves the output as an MP3 file.
@@ -56,7 +59,7 @@ def elevenlabs_tts(text):
   """
 
   print("- Converting text to speech...")
-  response = client.text_to_speech.convert(
+  response = registry.get("elevenlabs").text_to_speech.convert(
         voice_id = VOICE_ID,  
         output_format="mp3_22050_32",
         text=text,
@@ -76,8 +79,8 @@ def elevenlabs_tts(text):
   print(f"A new audio file was saved successfully at {save_file_path}")
   return save_file_path
 
-def audio_summarize(url):
-  content = load_content(url)
+def audio_summarize(url, page=None):
+  content = load_content(url, page)
   if content == "Content is too short to summarize. Less than 200 characters.":
     return content
   summary = summarize(content)
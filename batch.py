@@ -0,0 +1,231 @@
+"""
+Moderates a JSONL file of requests offline, one JSON object per line:
+    {"id": "a1", "text": "Some text to moderate."}
+    {"id": "a2", "images": ["https://example.com/a.jpg", "https://example.com/b.png"]}
+    {"id": "a3", "url": "https://example.com/article"}
+An optional "type" ("text", "image" or "url") overrides the detection from the keys. Results are written as NDJSON
+in input order, one line per input line. Sentences and images of many lines are in flight at once, so the text
+and image engines run full batches.
+Usage:
+    python batch.py archive.jsonl results.ndjson
+    python batch.py archive.jsonl results.ndjson --resume
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+# Input lines being processed at once; the output waits for the oldest one
+BATCH_MAX_IN_FLIGHT = int(os.getenv("BATCH_MAX_IN_FLIGHT", 256))
+BATCH_URL_WORKERS = int(os.getenv("BATCH_URL_WORKERS", 4))
+# Output lines written between two checkpoints
+CHECKPOINT_EVERY = int(os.getenv("BATCH_CHECKPOINT_EVERY", 100))
+TYPES = ("text", "image", "url")
+
+
+class Item:
+    """
+    One input line in flight: its futures and how to turn their results into the output record.
+    """
+
+    def __init__(self, line, end_offset, record=None, kind=None, futures=(), finish=None, error=None):
+        self.line = line
+        self.end_offset = end_offset
+        self.record = record
+        self.kind = kind
+        self.futures = list(futures)
+        self.finish = finish
+        self.error = error
+        self.start = time.perf_counter()
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def output(self):
+        output = {"line": self.line}
+        if isinstance(self.record, dict) and "id" in self.record:
+            output["id"] = self.record["id"]
+        output["type"] = self.kind
+        if self.error is None:
+            try:
+                output["result"] = self.finish([future.result() for future in self.futures])
+            except Exception as e:
+                self.error = str(e)
+        if self.error is not None:
+            output["error"] = self.error
+        return output
+
+
+def record_type(record):
+    if not isinstance(record, dict):
+        raise ValueError("Each line must be a JSON object")
+    kind = record.get("type") or next((kind for kind, key in zip(TYPES, ("text", "images", "url")) if key in record), None)
+    if kind not in TYPES:
+        raise ValueError(f"Cannot tell the type of the request, expected one of {', '.join(TYPES)}")
+    return kind
+
+def submit(line, end_offset, raw, url_pool):
+    """
+    Parses one input line and submits its work without waiting for it.
+    Returns:
+        Item or None: The item in flight, or None for a blank line.
+    """
+
+    from segmenter import splice
+    from queuing import submit_text_content, submit_image_content, process_url_content
+    if not raw.strip():
+        return None
+    try:
+        record = json.loads(raw)
+        kind = record_type(record)
+    except ValueError as e:
+        return Item(line, end_offset, error=str(e))
+    try:
+        if kind == "text":
+            text = record["text"]
+            spans, futures = submit_text_content(text)
+            return Item(line, end_offset, record, kind, futures, lambda results: splice(text, spans, results))
+        if kind == "image":
+            images = record["images"]
+            urls = images if isinstance(images, list) else [images]
+            return Item(line, end_offset, record, kind, submit_image_content(urls),
+                        lambda results: results if isinstance(images, list) else results[0])
+        return Item(line, end_offset, record, kind, [url_pool.submit(process_url_content, record["url"])],
+                    lambda results: results[0])
+    except (KeyError, ValueError) as e:
+        return Item(line, end_offset, record, kind, error=f"Invalid {kind} request: {e}")
+
+def read_checkpoint(path):
+    with open(path) as f:
+        return json.load(f)
+
+def write_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+def cache_stats():
+    import text_model
+    import image_model
+    import video_model
+    caches = [text_model.verdict_cache, text_model.rewrite_cache, image_model.url_cache, image_model.content_cache, video_model.video_cache]
+    return {cache.name: cache.stats() for cache in caches}
+
+def run(input_path, output_path, checkpoint_path, resume=False, max_in_flight=BATCH_MAX_IN_FLIGHT, url_workers=BATCH_URL_WORKERS):
+    """
+    Processes `input_path` into `output_path` and returns the run report.
+    With `resume`, processing restarts from the last checkpoint: the input is read from the checkpointed byte offset
+    and anything written to the output after the checkpoint is discarded, so every input line is written exactly once.
+    Returns:
+        dict: Items processed, throughput, per type counts and latencies, per stage times, engine and LLM times, and
+        cache hit rates.
+    """
+
+    import metrics
+    from queuing import agent
+    from llm_gateway import gateway
+    checkpoint = {"input_offset": 0, "line": 0, "output_offset": 0}
+    if resume and os.path.exists(checkpoint_path):
+        checkpoint = read_checkpoint(checkpoint_path)
+        print(f"- Resuming from line {checkpoint['line']}")
+    types = {kind: {"items": 0, "errors": 0, "seconds": 0.0} for kind in TYPES}
+    types[None] = {"items": 0, "errors": 0, "seconds": 0.0}
+    written = 0
+    start = time.perf_counter()
+    url_pool = ThreadPoolExecutor(max_workers=url_workers, thread_name_prefix="batch-url")
+    window = deque()
+
+    with open(input_path, "rb") as source, open(output_path, "r+b" if resume and os.path.exists(output_path) else "wb") as output:
+        source.seek(checkpoint["input_offset"])
+        output.seek(checkpoint["output_offset"])
+        output.truncate()
+        line = checkpoint["line"]
+
+        def write(item):
+            nonlocal written
+            record = item.output()
+            stats = types[item.kind]
+            stats["items"] += 1
+            stats["errors"] += "error" in record
+            stats["seconds"] += time.perf_counter() - item.start
+            output.write((json.dumps(record) + "\n").encode("utf-8"))
+            written += 1
+            if written % CHECKPOINT_EVERY == 0:
+                save(item.line + 1, item.end_offset)
+
+        def save(next_line, input_offset):
+            output.flush()
+            os.fsync(output.fileno())
+            write_checkpoint(checkpoint_path, {"input_offset": input_offset, "line": next_line, "output_offset": output.tell()})
+
+        offset = checkpoint["input_offset"]
+        for raw in iter(source.readline, b""):
+            offset += len(raw)
+            item = submit(line, offset, raw, url_pool)
+            line += 1
+            if item is not None:
+                window.append(item)
+            while window and (len(window) >= max_in_flight or window[0].done()):
+                write(window.popleft())
+        while window:
+            write(window.popleft())
+        save(line, offset)
+    url_pool.shutdown()
+
+    seconds = time.perf_counter() - start
+    return {
+        "items": written,
+        "seconds": seconds,
+        "items_per_second": written / seconds if seconds else 0.0,
+        "types": {kind or "invalid": {**stats, "avg_seconds": stats["seconds"] / stats["items"] if stats["items"] else 0.0}
+                  for kind, stats in types.items() if stats["items"]},
+        # Summed over the threads and processes the stages ran in, so they can add up to more than the run itself
+        "stages": {stage: {"count": count, "seconds": total, "avg_seconds": total / count if count else 0.0}
+                   for (stage,), (count, total) in sorted(metrics.STAGE_SECONDS.totals().items())},
+        "engines": {"text": agent.text_engine.stats(), "rewrite": agent.rewrite_engine.stats(), "image": agent.image_engine.stats()},
+        "llm": gateway.stats(),
+        "caches": cache_stats(),
+    }
+
+def print_report(report):
+    print(f"{report['items']} items in {report['seconds']:.1f} s ({report['items_per_second']:.1f} items/s)")
+    for kind, stats in report["types"].items():
+        print(f"  {kind:<8} {stats['items']:>7} items {stats['errors']:>5} errors  avg latency {stats['avg_seconds'] * 1000:.0f} ms")
+    for name, stats in report["stages"].items():
+        print(f"  stage {name:<16} {stats['seconds']:>8.1f} s over {stats['count']:>7} calls  avg {stats['avg_seconds'] * 1000:.1f} ms")
+    for name, stats in report["engines"].items():
+        print(f"  {name} engine: {stats['busy_seconds']:.1f} s busy, {stats['batches']} batches of {stats['avg_batch_size']:.1f} on average")
+    for name, stats in report["llm"].items():
+        if stats["calls"]:
+            print(f"  LLM {name}: {stats['calls']} calls, {stats['total_seconds']:.1f} s, {stats['failures']} failures")
+    for name, stats in report["caches"].items():
+        print(f"  cache {name}: {stats['hit_ratio']:.1%} hits ({stats['hits']} / {stats['hits'] + stats['misses']})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file of requests")
+    parser.add_argument("output", help="NDJSON file the results are written to")
+    parser.add_argument("--checkpoint", help="Checkpoint file. Defaults to <output>.checkpoint")
+    parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint instead of starting over")
+    parser.add_argument("--max-in-flight", type=int, default=BATCH_MAX_IN_FLIGHT)
+    parser.add_argument("--url-workers", type=int, default=BATCH_URL_WORKERS)
+    parser.add_argument("--report", help="Also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    if args.max_in_flight < 1:
+        sys.exit("--max-in-flight must be at least 1")
+    report = run(args.input, args.output, args.checkpoint or args.output + ".checkpoint", args.resume,
+                 args.max_in_flight, args.url_workers)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Offline micro-benchmarks of the pipeline's hot paths, run on the fixtures in fixtures/.
+In "stub" mode the models are replaced by stand-ins returning constant outputs, which measures the framework
+overhead (splitting, tokenization, batching, decoding, parsing) without downloading anything; "real" mode uses
+the actual models and needs them in the local Hugging Face cache. Nothing touches the network in either mode.
+Usage:
+    python bench.py run --mode stub --output before.json
+    python bench.py run --mode real --only classify_hate_speech summarize
+    python bench.py compare before.json after.json --threshold 0.1
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import glob
+import platform
+import argparse
+import contextlib
+import statistics
+import subprocess
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+PAGE_URL = "https://news.example.com/local/riverton-water-plant"
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function prepares its inputs and returns `(fn, items)`,
+    where `fn()` is the timed call and `items` the number of items it processes.
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class StubTokenizer:
+    """
+    Stand-in for a Hugging Face tokenizer: one id per whitespace separated word, padded like the real one.
+    """
+
+    def __call__(self, texts, truncation=False, max_length=512, padding=None, return_tensors=None, **kwargs):
+        texts = [texts] if isinstance(texts, str) else texts
+        input_ids = []
+        for text in texts:
+            ids = [zlib.crc32(word.encode()) % 50000 + 3 for word in text.split()]
+            input_ids.append([0] + (ids[:max_length - 2] if truncation else ids) + [2])
+        if return_tensors == "pt":
+            return self.pad({"input_ids": input_ids}, return_tensors="pt")
+        return {"input_ids": input_ids}
+
+    def pad(self, encoded, return_tensors=None):
+        import torch
+        from transformers import BatchEncoding
+        width = max(len(ids) for ids in encoded["input_ids"])
+        return BatchEncoding({
+            "input_ids": torch.tensor([ids + [1] * (width - len(ids)) for ids in encoded["input_ids"]]),
+            "attention_mask": torch.tensor([[1] * len(ids) + [0] * (width - len(ids)) for ids in encoded["input_ids"]]),
+        })
+
+    def batch_decode(self, sequences, **kwargs):
+        return [" ".join(str(token) for token in sequence.tolist()) for sequence in sequences]
+
+
+class StubModel:
+    """
+    Stand-in for the classifiers and the summarizer: constant logits, and generated ids of the minimum length.
+    """
+
+    def __call__(self, input_ids=None, attention_mask=None, pixel_values=None):
+        import torch
+        from types import SimpleNamespace
+        batch = input_ids if input_ids is not None else pixel_values
+        return SimpleNamespace(logits=torch.zeros(batch.shape[0], 2))
+
+    def parameters(self):
+        return iter(())
+
+    def generate(self, input_ids, min_length=0, max_length=20, **kwargs):
+        import torch
+        return torch.zeros(input_ids.shape[0], max(min_length, 1), dtype=torch.long)
+
+
+def stub_processor(images, return_tensors="pt"):
+    import torch
+    import numpy as np
+    pixels = np.asarray(images.resize((224, 224)), dtype=np.float32) / 255
+    return {"pixel_values": torch.from_numpy(pixels).permute(2, 0, 1).unsqueeze(0)}
+
+def install_stubs():
+    # These modules register their real loaders when imported, which would replace stubs installed before them
+    import text_model
+    import image_model
+    import summarizer
+    from models import registry
+    labels = {"hate_speech": {0: "nothate", 1: "hate"}, "nsfw": {0: "normal", 1: "nsfw"}}
+    registry.register("hate_speech", lambda: {"tokenizer": StubTokenizer(), "model": StubModel(), "onnx_classifier": None, "id2label": labels["hate_speech"]})
+    registry.register("nsfw", lambda: {"processor": stub_processor, "model": StubModel(), "onnx_classifier": None, "id2label": labels["nsfw"]})
+    registry.register("summarizer", lambda: {"tokenizer": StubTokenizer(), "model": StubModel()})
+
+def read_fixture(*path, mode="r"):
+    with open(os.path.join(FIXTURES, *path), mode) as f:
+        return f.read()
+
+def fixture_sentences():
+    return [json.loads(line)["text"] for line in read_fixture("sentences.jsonl").splitlines() if line.strip()]
+
+def fixture_images():
+    return [read_fixture("images", os.path.basename(path), mode="rb") for path in sorted(glob.glob(os.path.join(FIXTURES, "images", "*")))]
+
+def uncached_text_model():
+    # Every iteration must reach the model, so verdicts are not remembered
+    import text_model
+    from cache import TwoTierCache
+    text_model.verdict_cache = TwoTierCache("bench_verdicts", max_entries=0, cache_dir="")
+    return text_model
+
+
+@benchmark("split_sentences")
+def bench_split_sentences():
+    from segmenter import sentence_spans
+    text = read_fixture("article.txt") * 20
+    return lambda: sentence_spans(text), len(sentence_spans(text))
+
+@benchmark("prefilter")
+def bench_prefilter():
+    from prefilter import Prefilter, load_lexicon
+    prefilter = Prefilter(load_lexicon())
+    sentences = fixture_sentences()
+    return lambda: [prefilter.hate_probability(sentence) for sentence in sentences], len(sentences)
+
+@benchmark("tokenize_sentences")
+def bench_tokenize_sentences():
+    import text_model
+    from models import registry
+    tokenizer = registry.get("hate_speech")["tokenizer"]
+    sentences = fixture_sentences()
+    return lambda: tokenizer(sentences, truncation=True), len(sentences)
+
+@benchmark("classify_hate_speech")
+def bench_classify_hate_speech():
+    text_model = uncached_text_model()
+    sentences = fixture_sentences()
+    return lambda: text_model.classify_hate_speech(sentences), len(sentences)
+
+@benchmark("preprocess_image")
+def bench_preprocess_image():
+    import image_model
+    images = fixture_images()
+    return lambda: [image_model.preprocess_image(data) for data in images], len(images)
+
+@benchmark("classify_images")
+def bench_classify_images():
+    import image_model
+    pixel_values = [image_model.preprocess_image(data) for data in fixture_images()] * 8
+    return lambda: image_model.classify_images(pixel_values), len(pixel_values)
+
+@benchmark("parse_page")
+def bench_parse_page():
+    from page_context import PageContext
+    html = read_fixture("page.html", mode="rb")
+    return lambda: PageContext(PAGE_URL, html).soup, 1
+
+@benchmark("scrape_content")
+def bench_scrape_content():
+    from scrape import scrape_content
+    from page_context import PageContext
+    html = read_fixture("page.html", mode="rb")
+    return lambda: scrape_content(PAGE_URL, PageContext(PAGE_URL, html)), 1
+
+@benchmark("summarize")
+def bench_summarize():
+    from summarizer import summarize
+    article = read_fixture("article.txt")
+    return lambda: summarize(article), 1
+
+
+def measure(fn, items, min_iterations, min_seconds, max_iterations=1000):
+    fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_iterations and (len(times) < min_iterations or time.perf_counter() - start < min_seconds):
+        begin = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - begin)
+    times.sort()
+    median = statistics.median(times)
+    return {
+        "iterations": len(times),
+        "items": items,
+        "median_ms": median * 1000,
+        "mean_ms": statistics.fmean(times) * 1000,
+        "min_ms": times[0] * 1000,
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+        "items_per_second": items / median if median else 0.0,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(mode, names, min_iterations, min_seconds):
+    """
+    Runs the selected benchmarks and returns the results document written by `python bench.py run`.
+    """
+
+    # Offline and side-effect free: no LLM calls, no cache or trace files, no downloads
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ["TRACE_LOG"] = ""
+    os.environ["CACHE_DIR"] = ""
+    os.environ["IMAGE_CACHE_DIR"] = ""
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    if mode == "stub":
+        install_stubs()
+    import torch
+    results = {}
+    for name in names:
+        fn, items = BENCHMARKS[name]()
+        results[name] = measure(fn, items, min_iterations, min_seconds)
+        print(f"{name:<22} {results[name]['median_ms']:>10.3f} ms  {results[name]['items_per_second']:>10.1f} items/s  ({results[name]['iterations']} runs)", file=sys.stderr)
+    return {
+        "mode": mode,
+        "commit": git_commit(),
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+def compare(before, after, threshold):
+    """
+    Prints the change of every benchmark's median between two results documents.
+    Returns:
+        list: The names of the benchmarks whose median got slower by more than `threshold` (a fraction).
+    """
+
+    if before["mode"] != after["mode"]:
+        print(f"Warning: comparing {before['mode']} mode against {after['mode']} mode")
+    regressions = []
+    print(f"{'benchmark':<22} {before.get('commit') or 'before':>10} {after.get('commit') or 'after':>10}   change")
+    for name in sorted(set(before["results"]) | set(after["results"])):
+        if name not in before["results"] or name not in after["results"]:
+            print(f"{name:<22} only in {'after' if name in after['results'] else 'before'}")
+            continue
+        old, new = before["results"][name]["median_ms"], after["results"][name]["median_ms"]
+        change = (new - old) / old if old else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<22} {old:>8.3f}ms {new:>8.3f}ms {change:>+8.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--mode", choices=["stub", "real"], default="stub")
+    run_parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run. Defaults to all")
+    run_parser.add_argument("--min-iterations", type=int, default=5)
+    run_parser.add_argument("--min-seconds", type=float, default=1.0)
+    run_parser.add_argument("--output", help="Write the results as JSON to this file instead of stdout")
+    compare_parser = commands.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown of the median counted as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        # The pipeline's progress prints would otherwise end up in the JSON written to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run(args.mode, args.only or list(BENCHMARKS), args.min_iterations, args.min_seconds)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        return
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if compare(before, after, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import weakref
+import metrics
+import unicodedata
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+# Directory holding the on-disk tier of every cache; set CACHE_DIR="" to keep caches in memory only.
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+
+def normalize_text(text):
+    """
+    Normalizes a sentence so that trivially different copies share a cache entry.
+    Applies NFKC unicode normalization and collapses runs of whitespace into a single space.
+    Args:
+        text (str): The sentence to normalize.
+    Returns:
+        str: The normalized sentence.
+    """
+
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def make_key(text, model_id):
+    """
+    Builds a content-addressed cache key from a sentence and the id of the model that produced the value.
+    Args:
+        text (str): The sentence being cached.
+        model_id (str): Identifier of the model (and prompt/config version) the value belongs to.
+    Returns:
+        str: A hex SHA-256 digest of the model id and the normalized sentence.
+    """
+
+    return hashlib.sha256(f"{model_id}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# Every cache of the process, for the metrics below
+caches = weakref.WeakSet()
+
+
+class TwoTierCache:
+    """
+    Two-tier key/value cache: an in-memory LRU in front of an on-disk SQLite store.
+    Values must be JSON serializable. Lookups check memory first, then disk; disk hits are promoted
+    into memory. The SQLite file runs in WAL mode, so several processes can share one cache directory.
+    Attributes:
+        name (str): Name of the cache, also used for the SQLite file name.
+        max_entries (int): Maximum number of entries kept in memory before the least recently used are evicted.
+        max_disk_entries (int): Maximum number of entries kept on disk before the least recently used are evicted.
+        ttl (float or None): Time to live of an entry in seconds, or None for entries that never expire.
+        hits (int): Number of lookups served from memory or disk.
+        disk_hits (int): Number of lookups served from disk.
+        misses (int): Number of lookups that found no fresh entry.
+    Methods:
+        get(key): Returns the cached value, or None on a miss.
+        set(key, value): Stores a value in both tiers.
+        stats(): Returns the hit/miss counters and the current memory size.
+    """
+
+    def __init__(self, name, max_entries=10000, max_disk_entries=1000000, ttl=None, cache_dir=CACHE_DIR):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        caches.add(self)
+        self._db = None
+        self._path = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._path = os.path.join(cache_dir, f"{name}.sqlite3")
+            self._db = self._connect()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            self._db.commit()
+        # A SQLite connection must not be used across fork(), so forked workers open their own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30, check_same_thread=False)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        if self._path:
+            self._db = self._connect()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    self._db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), expires_at, now),
+                )
+                self._puts += 1
+                if self._puts % 1000 == 0:
+                    self._evict_disk(now)
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        self._db.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_disk_entries,),
+            )
+
+
+def cache_lookups():
+    lookups = []
+    for cache in list(caches):
+        stats = cache.stats()
+        lookups.append(({"cache": cache.name, "result": "memory_hit"}, stats["hits"] - stats["disk_hits"]))
+        lookups.append(({"cache": cache.name, "result": "disk_hit"}, stats["disk_hits"]))
+        lookups.append(({"cache": cache.name, "result": "miss"}, stats["misses"]))
+    return lookups
+
+metrics.Counter("cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"], fn=cache_lookups)
+metrics.Gauge("cache_hit_ratio", "Share of cache lookups served from memory or disk", ["cache"],
+              fn=lambda: [({"cache": cache.name}, cache.stats()["hit_ratio"]) for cache in list(caches)])
@@ -1,9 +1,19 @@
 import os
+import time
 import gradio as gr
+import requests
 from scrape import scrape_content
-from queuing import process_text_content, process_image_content, process_url_content, process_audio_content
+from page_context import get_page
+from models import registry, WARMUP_MODELS
+from segmenter import splice
+from queuing import submit_text_content, submit_image_content, process_url_content, process_audio_content
 
 aud = None
+# Minimum number of seconds between two full renders of the page while it is being processed
+RENDER_INTERVAL = float(os.getenv("RENDER_INTERVAL", 2))
+
+def render(soup):
+    return soup.prettify(formatter='html').encode('utf-8').decode('utf-8')
 
 def process_content(url, toggle_state1, toggle_state2):
     """
@@ -19,10 +29,13 @@ def process_content(url, toggle_state1, toggle_state2):
             - dict or None: The result of the news credibility analysis, if performed.
             - str or None: The path to the generated audio summary, if created.
     Notes:
+        - The page is downloaded and parsed once, and shared by the scraping, YouTube link extraction and audio summary.
         - The function scrapes the content from the given URL and processes text and images.
         - If `toggle_state1` is True, it analyzes the news credibility of the URL content.
         - If `toggle_state2` is True, it generates an audio summary of the URL content.
         - The function yields intermediate results at various stages of processing.
+        - While elements are processed, the page is rendered at most once every `RENDER_INTERVAL` seconds; 
+          the other steps only update the status, so the cost of rendering stays linear in the page size.
     """
 
     print("- Working on new URL...")
@@ -34,7 +47,12 @@ def process_content(url, toggle_state1, toggle_state2):
     else:
         audio_summary = None
     json_result = None
-    content, soup = scrape_content(url)
+    try:
+        page = get_page(url)
+    except requests.exceptions.RequestException as e:
+        yield "Error", f"Error fetching the content from URL: {e}", json_result, audio_summary
+        return
+    content, soup = scrape_content(url, page)
     if soup is None:
         yield "Error", content, json_result, audio_summary
 
@@ -43,41 +61,50 @@ def process_content(url, toggle_state1, toggle_state2):
     for link in content['css_links']:
         soup.head.append(link)  
 
-    for i, text in enumerate(content['text']):
-        processed_text = process_text_content(text)
-        element = soup.find_all(['p', 'h1', 'h2', 'h3', 'span', 'a', 'li'])[i]
+    last_render = time.time()
+    def throttled_render():
+        nonlocal last_render
+        if time.time() - last_render < RENDER_INTERVAL:
+            return gr.update()
+        last_render = time.time()
+        return render(soup)
+
+    # Every element is queued before the first result is awaited, so the text engine batches the sentences of the
+    # whole page instead of waiting out its batching window for each element in turn
+    text_submissions = [submit_text_content(text) for text in content['text']]
+    for i, (text, (spans, futures), element) in enumerate(zip(content['text'], text_submissions, content['text_elements'])):
+        processed_text = splice(text, spans, [future.result() for future in futures])
         if element.string:
             element.string.replace_with(processed_text)
-        else:
-            element = processed_text
-        yield f"Processing text... ({i+1}/{len(content['text'])})", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
+        yield f"Processing text... ({i+1}/{len(content['text'])})", throttled_render(), json_result, audio_summary
 
-    for i, img_src in enumerate(content['images']):
-        processed_image = process_image_content(img_src) 
-        soup.find_all('img')[i]['src'] = processed_image
-        yield f"Processing images... ({i+1}/{len(content['images'])})", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
+    image_futures = submit_image_content(content['images'])
+    for i, (future, element) in enumerate(zip(image_futures, content['image_elements'])):
+        element['src'] = future.result()
+        yield f"Processing images... ({i+1}/{len(content['images'])})", throttled_render(), json_result, audio_summary
 
+    html = render(soup)
     toggledPrior2 = False
     if toggle_state2 and not toggledPrior2:
-        yield "Generating audio summary...", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
-        audio_summary = process_audio_content(url)
+        yield "Generating audio summary...", html, json_result, audio_summary
+        audio_summary = process_audio_content(url, page)
         if audio_summary == "Content is too short to summarize. Less than 200 characters.":
             audio_summary = None
             print("Content is too short to summarize. Less than 200 characters.")
         aud = audio_summary
         toggledPrior2 = True
-        yield "Audio Summary Generated", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
+        yield "Audio Summary Generated", html, json_result, audio_summary
 
 
     toggledPrior1 = False
     if toggle_state1 and not toggledPrior1:
-        yield "Analyzing News Credibility...", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
-        json_result = process_url_content(url) 
+        yield "Analyzing News Credibility...", html, json_result, audio_summary
+        json_result = process_url_content(url, page) 
         toggledPrior = True
-        yield "News Credibility Analyzed", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
+        yield "News Credibility Analyzed", html, json_result, audio_summary
 
         
-    yield "Processing complete", soup.prettify(formatter='html').encode('utf-8').decode('utf-8'), json_result, audio_summary
+    yield "Processing complete", html, json_result, audio_summary
 
   
 # gradio interface
@@ -98,4 +125,6 @@ with gr.Blocks() as demo:
     html_output = gr.HTML(label="Modified Webpage")
     submit_btn.click(process_content, inputs=[url_input, toggle_button1, toggle_button2], outputs=[status_output, html_output, json_output, audio_output])
 
-demo.launch(debug=True)
\ No newline at end of file
+if __name__ == '__main__':
+    registry.warmup(WARMUP_MODELS)
+    demo.launch(debug=True)
\ No newline at end of file
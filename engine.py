@@ -0,0 +1,130 @@
+import os
+import time
+import queue
+import threading
+import metrics
+import tracing
+from concurrent.futures import Future
+
+
+class BatchEngine:
+    """
+    Request-scoped micro-batching engine.
+    Every submitted item gets its own Future, so concurrent callers never share result storage.
+    A single worker thread drains the queue and coalesces pending items into dynamic batches (a forked child
+    process starts its own worker thread with an empty queue):
+    a batch is dispatched as soon as it holds `max_batch_size` items, or when `max_wait_ms`
+    has passed since its first item arrived, whichever comes first.
+    Items remember the trace they were submitted from: every batch is recorded as a span of each trace that has
+    items in it, with the time its items waited in the queue, or with `trace_items` one span per item.
+    Attributes:
+        batch_fn (callable): Function taking a list of items and returning a list of results in the same order.
+            An exception returned as an item's result fails only that item's Future; an exception raised fails them all.
+        max_batch_size (int): Upper bound on the number of items handed to `batch_fn` at once.
+        max_wait_ms (float): How long the worker waits for more items before dispatching a partial batch.
+        name (str): Name used for the worker thread.
+        trace_items (bool): Record a span per item rather than per batch and trace, for engines with few, slow items.
+    Methods:
+        submit(item): Queues one item and returns a Future for its result.
+        submit_many(items): Queues several items and returns their Futures in input order.
+        map(items): Submits items and blocks until all of their results are available.
+        stats(): Returns the number of batches and items processed and the seconds spent in `batch_fn`.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=32, max_wait_ms=10, name="engine", trace_items=False):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+        self.trace_items = trace_items
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._start()
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future, tracing.current(), time.perf_counter()))
+        return future
+
+    def submit_many(self, items):
+        return [self.submit(item) for item in items]
+
+    def map(self, items):
+        return [future.result() for future in self.submit_many(items)]
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "busy_seconds": self.busy_seconds,
+        }
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            pending = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not pending:
+                continue
+            start_time, start = time.time(), time.perf_counter()
+            error = None
+            try:
+                results = self.batch_fn([item for item, *_ in pending])
+                if len(results) != len(pending):
+                    raise RuntimeError(f"{self.name}: batch function returned {len(results)} results for {len(pending)} items")
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                for _, future, *_ in pending:
+                    future.set_exception(e)
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                self.batches += 1
+                self.items += len(pending)
+                self.busy_seconds += elapsed
+                metrics.BATCH_SIZE.observe(len(pending), engine=self.name)
+                metrics.BATCH_SECONDS.observe(elapsed, engine=self.name)
+                self._trace(pending, start_time, start, elapsed, error)
+            for (_, future, *_), result in zip(pending, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _trace(self, pending, start_time, start, elapsed, error):
+        if self.trace_items:
+            for item, _, context, submitted in pending:
+                if context is not None:
+                    tracing.record_span(f"{self.name}.item", context, start_time, elapsed, error=error, item=str(item)[:200],
+                                        batch_size=len(pending), queue_ms=(start - submitted) * 1000)
+            return
+        traces = {}
+        for _, _, context, submitted in pending:
+            if context is not None:
+                traces.setdefault(context, []).append(submitted)
+        for context, submitted in traces.items():
+            tracing.record_span(f"{self.name}.batch", context, start_time, elapsed, error=error, items=len(submitted),
+                                batch_size=len(pending), queue_ms=(start - min(submitted)) * 1000)
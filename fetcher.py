@@ -0,0 +1,119 @@
+import os
+import threading
+import requests
+import metrics
+from collections import namedtuple, deque
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, Future
+
+MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", 16))
+MAX_PER_HOST = int(os.getenv("FETCH_MAX_PER_HOST", 4))
+CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("FETCH_READ_TIMEOUT", 10))
+MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", 10 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+# `content` is None whenever the body was not downloaded: request errors (status_code None),
+# non-200 responses, unwanted Content-Types and bodies larger than the byte limit.
+FetchResult = namedtuple("FetchResult", ["url", "status_code", "headers", "content"])
+
+
+def content_length(headers):
+    # A malformed Content-Length is ignored; the streamed byte cutoff still applies
+    try:
+        return int(headers.get("Content-Length") or 0)
+    except ValueError:
+        return 0
+
+class ImageFetcher:
+    """
+    Concurrent image fetcher backed by a pooled HTTP session.
+    Downloads are spread over a thread pool bounded overall and per host, use connect/read timeouts,
+    are skipped early by Content-Type, and are streamed with a byte cutoff instead of being read whole.
+    The per-host limit is applied before downloads reach the pool: each host gets at most `max_per_host` tasks
+    in the pool at once, each running one download and then resubmitting itself for the host's next URL, so
+    images from a busy host queue outside the pool instead of holding worker threads other hosts could use.
+    Attributes:
+        session (requests.Session): Shared session whose connection pool is reused across downloads.
+        max_per_host (int): Maximum number of concurrent downloads from a single host.
+        timeout (tuple): `(connect, read)` timeouts in seconds.
+        max_bytes (int): Bodies larger than this are abandoned.
+    Methods:
+        fetch(url, headers): Downloads a single image in the calling thread and returns a FetchResult.
+        submit(url, headers): Queues a download and returns a Future for its FetchResult.
+        fetch_all(urls, headers_list): Downloads several images concurrently and returns their FetchResults in input order.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_bytes=MAX_BYTES):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.max_per_host = max_per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-fetch")
+        # Downloads waiting for a slot of their host, and the number of pool tasks working for each host
+        self._pending = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url, headers=None):
+        future = Future()
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._pending.setdefault(host, deque()).append((url, headers, future))
+            if self._running.get(host, 0) >= self.max_per_host:
+                return future
+            self._running[host] = self._running.get(host, 0) + 1
+        self.executor.submit(self._run_next, host)
+        return future
+
+    def _run_next(self, host):
+        with self._lock:
+            pending = self._pending.get(host)
+            if not pending:
+                self._pending.pop(host, None)
+                self._running[host] -= 1
+                if not self._running[host]:
+                    del self._running[host]
+                return
+            url, headers, future = pending.popleft()
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.fetch(url, headers))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            self.executor.submit(self._run_next, host)
+
+    def fetch(self, url, headers=None):
+        if urlsplit(url).path.endswith(".svg"):
+            return FetchResult(url, None, {}, None)
+        with metrics.stage("fetch_image"):
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code != 200:
+                        return FetchResult(url, response.status_code, response.headers, None)
+                    content_type = response.headers.get("Content-Type", "image/")
+                    if not content_type.startswith("image/") or content_type.startswith("image/svg"):
+                        return FetchResult(url, response.status_code, response.headers, None)
+                    if content_length(response.headers) > self.max_bytes:
+                        return FetchResult(url, response.status_code, response.headers, None)
+                    body = bytearray()
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        body.extend(chunk)
+                        if len(body) > self.max_bytes:
+                            return FetchResult(url, response.status_code, response.headers, None)
+                    return FetchResult(url, response.status_code, response.headers, bytes(body))
+            except requests.exceptions.RequestException as e:
+                print(f"- Failed to fetch image {url}: {e}")
+                return FetchResult(url, None, {}, None)
+
+    def fetch_all(self, urls, headers_list=None):
+        headers_list = headers_list or [None] * len(urls)
+        futures = [self.submit(url, headers) for url, headers in zip(urls, headers_list)]
+        return [future.result() for future in futures]
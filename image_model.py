@@ -1,10 +1,20 @@
+import os
+import time
 import torch
 import base64
-import requests
+import hashlib
 # import subprocess
-from PIL import Image
 from io import BytesIO
-from transformers import AutoModelForImageClassification, ViTImageProcessor
+from PIL import Image, UnidentifiedImageError
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoConfig, AutoModelForImageClassification, ViTImageProcessor
+from cache import CACHE_DIR, TwoTierCache
+from fetcher import ImageFetcher
+from inference_mode import optimize_model, model_dtype
+from onnx_backend import load_classifier, classifier_tag
+from models import registry
+import metrics
 
 # cat = "https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcTeKOOpLy92UjzQxq8NCxgxOQJbj_YVdfHO_g&s"
 # cat = "https://upload.wikimedia.org/wikipedia/commons/thumb/3/3a/Cat03.jpg/1200px-Cat03.jpg"
@@ -12,54 +22,207 @@ from transformers import AutoModelForImageClassification, ViTImageProcessor
 # cat_image_data = base64.b64encode(cat_image_response.content).decode('utf-8')
 # cat_image_base64 = f"data:image/jpeg;base64,{cat_image_data}"
 local_image_path = './media/car.png'
-with open(local_image_path, 'rb') as image_file:
-    car_image_data = base64.b64encode(image_file.read()).decode('utf-8')
-car_image_base64 = f"data:image/png;base64,{car_image_data}"
+
+@lru_cache(maxsize=None)
+def car_image_base64():
+    """
+    Returns the placeholder shown instead of NSFW images as a data URL, reading it on first use.
+    """
+
+    with open(local_image_path, 'rb') as image_file:
+        car_image_data = base64.b64encode(image_file.read()).decode('utf-8')
+    return f"data:image/png;base64,{car_image_data}"
 
 MODEL = "Falconsai/nsfw_image_detection"
+# Content cache model id: labels from another backend or inference mode of the model are not reused
+CONTENT_MODEL_ID = f"{MODEL}:{classifier_tag('image')}"
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = AutoModelForImageClassification.from_pretrained(MODEL)
-processor = ViTImageProcessor.from_pretrained(MODEL)
-model.to(device)
 
-def detect_nsfw_image(url):
+def load_nsfw_model():
     """
-    Detects whether an image at a given URL is NSFW (Not Safe For Work) and replaces it with a placeholder if it is.
+    Loads the NSFW classifier; registered as "nsfw" and called once by the model registry.
+    Returns:
+        dict: The image `processor`, the `id2label` mapping, and either the ONNX `onnx_classifier` (when 
+        CLASSIFIER_BACKEND=onnx and the graph has been exported) or the PyTorch `model`; the other one is None.
+    """
+
+    onnx_classifier = load_classifier("image")
+    model = None
+    if onnx_classifier is None:
+        model = AutoModelForImageClassification.from_pretrained(MODEL)
+        model = optimize_model(model.to(device), device)
+    return {
+        "processor": ViTImageProcessor.from_pretrained(MODEL),
+        "model": model,
+        "onnx_classifier": onnx_classifier,
+        "id2label": AutoConfig.from_pretrained(MODEL).id2label,
+    }
+
+registry.register("nsfw", load_nsfw_model)
+
+# How long a URL is trusted without revalidating it against the server (ETag / Last-Modified)
+URL_TTL = float(os.getenv("IMAGE_URL_CACHE_TTL", 24 * 3600))
+# Set IMAGE_CACHE_DIR="" to keep image verdicts in memory only
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", CACHE_DIR)
+url_cache = TwoTierCache("image_urls", max_entries=20000, cache_dir=IMAGE_CACHE_DIR)
+content_cache = TwoTierCache("image_verdicts", max_entries=20000, cache_dir=IMAGE_CACHE_DIR)
+fetcher = ImageFetcher()
+BATCH_SIZE = int(os.getenv("IMAGE_BATCH_SIZE", 16))
+preprocess_pool = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_PREPROCESS_WORKERS", 4)), thread_name_prefix="image-preprocess")
+
+@metrics.stage("preprocess_image")
+def preprocess_image(data):
+    """
+    Decodes raw image bytes and turns them into the model's pixel values.
     Args:
-        url (str): The URL of the image to be checked.
+        data (bytes): The downloaded image.
     Returns:
-        str: The original URL if the image is not NSFW, or a placeholder if it is.
+        torch.Tensor or None: The `(3, H, W)` pixel values, or None if the bytes are not a readable image.
+    """
+
+    try:
+        img = Image.open(BytesIO(data)).convert("RGB")
+    except (UnidentifiedImageError, OSError):
+        return None
+    return registry.get("nsfw")["processor"](images=img, return_tensors="pt")["pixel_values"][0]
+
+def classify_images(pixel_values, batch_size=BATCH_SIZE):
+    """
+    Classifies preprocessed images with the NSFW detection model, one stacked forward pass per batch.
+    Args:
+        pixel_values (list): Pixel value tensors as returned by `preprocess_image`.
+        batch_size (int, optional): The maximum number of images per forward pass. Defaults to `BATCH_SIZE`.
+    Returns:
+        list: A `(label, probability)` tuple for each image, in input order.
+    """
+
+    classifier = registry.get("nsfw")
+    model = classifier["model"]
+    results = []
+    for start in range(0, len(pixel_values), batch_size):
+        batch = torch.stack(pixel_values[start:start + batch_size])
+        with metrics.stage("inference_image"):
+            if classifier["onnx_classifier"] is not None:
+                probs = classifier["onnx_classifier"].logits(pixel_values=batch).float().softmax(-1)
+            else:
+                with torch.no_grad():
+                    probs = model(pixel_values=batch.to(device, dtype=model_dtype(model))).logits.float().softmax(-1)
+        scores, class_ids = probs.max(-1)
+        for class_id, score in zip(class_ids.tolist(), scores.tolist()):
+            results.append((classifier["id2label"][class_id], score))
+    return results
+
+def content_key(digest):
+    return f"{CONTENT_MODEL_ID}:{digest}"
+
+def apply_label(url, label):
+    if label == "nsfw":
+        print("- Replaceing NSFW Image...")
+        # subprocess.run(["echo", "- Replaceing NSFW Image..."])
+        return car_image_base64()
+    return url
+
+def detect_nsfw_images(urls):
+    """
+    Detects which of the images at the given URLs are NSFW (Not Safe For Work) and replaces them with a placeholder.
+    Images that are not answered from the cache are downloaded concurrently by the shared `fetcher`, so the 
+    time spent on a page's images tracks the slowest download rather than the sum of all of them. New images 
+    are decoded and preprocessed in `preprocess_pool` and classified together by `classify_images`.
+    Args:
+        urls (list): The URLs of the images to be checked.
+    Returns:
+        list: For each URL, in input order, the original URL if the image is not NSFW, or a placeholder if it is.
     Raises:
-        requests.exceptions.RequestException: If there is an issue with the HTTP request.
-        PIL.UnidentifiedImageError: If the image cannot be opened and identified.
         torch.TorchException: If there is an issue with the PyTorch model inference.
     Notes:
         - This function uses a pre-trained model to classify images.
-        - The function assumes that the model and processor are already defined and loaded.
+        - The model and processor are loaded through the model registry on first use.
         - The placeholder image is represented by the variable `cat`.
+        - Verdicts are cached by URL (revalidated with ETag / Last-Modified after `URL_TTL` seconds) and by
+          the SHA-256 of the downloaded bytes, so CDN-renamed copies of an image are not classified again.
+        - SVGs, failed downloads, non-image Content-Types, oversized bodies and undecodable images are returned unchanged.
     """
 
     print("- Detecting NSFW Image...")
     # subprocess.run(["echo", "- Detecting NSFW Image..."])
-    response = requests.get(url)
-    if url.endswith(".svg") or response.status_code != 200:
-        return url
-    else:
-        img = Image.open(BytesIO(response.content)).convert("RGB")
-
-    with torch.no_grad():
-        inputs = processor(images=img, return_tensors="pt")
-        outputs = model(**inputs.to(device))
-        logits = outputs.logits
-
-    predicted_label = logits.argmax(-1).item()
-    label = model.config.id2label[predicted_label]
-    if label == "nsfw":
-        print("- Replaceing NSFW Image...")
-        # subprocess.run(["echo", "- Replaceing NSFW Image..."])
-        return car_image_base64
-    elif label == "normal":
-        return url
+    results = list(urls)
+    entries = {}
+    to_fetch = []
+    for i, url in enumerate(urls):
+        if url.endswith(".svg"):
+            continue
+        entry = url_cache.get(url)
+        if entry is not None:
+            label = content_cache.get(content_key(entry["sha256"]))
+            if label is not None and time.time() - entry["checked_at"] < URL_TTL:
+                results[i] = apply_label(url, label)
+                continue
+            if label is not None:
+                entries[i] = entry
+        to_fetch.append(i)
+
+    headers_list = []
+    for i in to_fetch:
+        headers = {}
+        entry = entries.get(i)
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        headers_list.append(headers)
+    responses = fetcher.fetch_all([urls[i] for i in to_fetch], headers_list)
+
+    downloaded = []
+    for i, response in zip(to_fetch, responses):
+        url = urls[i]
+        entry = entries.get(i)
+        if response.status_code == 304 and entry is not None:
+            entry["checked_at"] = time.time()
+            url_cache.set(url, entry)
+            results[i] = apply_label(url, content_cache.get(content_key(entry["sha256"])))
+        elif response.content is not None:
+            downloaded.append((i, response, hashlib.sha256(response.content).hexdigest()))
+
+    labels = {}
+    unseen = {}
+    for _, response, digest in downloaded:
+        if digest in labels or digest in unseen:
+            continue
+        label = content_cache.get(content_key(digest))
+        if label is not None:
+            labels[digest] = label
+        else:
+            unseen[digest] = response.content
+    pixel_values = list(preprocess_pool.map(preprocess_image, unseen.values()))
+    readable = [(digest, values) for digest, values in zip(unseen, pixel_values) if values is not None]
+    predictions = classify_images([values for _, values in readable])
+    for (digest, _), (label, _) in zip(readable, predictions):
+        labels[digest] = label
+        content_cache.set(content_key(digest), label)
+
+    for i, response, digest in downloaded:
+        if digest not in labels:
+            continue
+        url_cache.set(urls[i], {
+            "sha256": digest,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked_at": time.time(),
+        })
+        results[i] = apply_label(urls[i], labels[digest])
+    return results
+
+def detect_nsfw_image(url):
+    """
+    Detects whether an image at a given URL is NSFW (Not Safe For Work) and replaces it with a placeholder if it is.
+    Args:
+        url (str): The URL of the image to be checked.
+    Returns:
+        str: The original URL if the image is not NSFW, or a placeholder if it is.
+    """
+
+    return detect_nsfw_images([url])[0]
 
 # url = "https://www.nvidia.com/content/dam/en-zz/Solutions/gpu-cloud/ngc-enterprise-cloud-services-2c50-d.jpg"
\ No newline at end of file
@@ -0,0 +1,54 @@
+import os
+import torch
+from dotenv import load_dotenv
+
+load_dotenv()
+# "fp32" (default) keeps the full precision weights, "int8" applies dynamic int8 quantization to the Linear
+# layers and "bf16" casts the weights to bfloat16 where the CPU supports it. Only applies to CPU inference.
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "fp32")
+INFERENCE_MODES = ("fp32", "int8", "bf16")
+
+
+def bf16_supported():
+    """
+    Tells whether the CPU has native bfloat16 support (e.g. AVX512-BF16 or AMX), without which bf16 is slower than fp32.
+    """
+
+    is_supported = getattr(torch.ops.mkldnn, "_is_mkldnn_bf16_supported", None)
+    return torch.backends.mkldnn.is_available() and is_supported is not None and is_supported()
+
+def optimize_model(model, device, mode=INFERENCE_MODE, allow_bf16=True):
+    """
+    Applies the configured inference mode to a loaded model.
+    Args:
+        model (torch.nn.Module): The fp32 model, already moved to `device`.
+        device (torch.device or str): The device the model runs on; only CPU models are changed.
+        mode (str, optional): One of `INFERENCE_MODES`. Defaults to `INFERENCE_MODE`.
+        allow_bf16 (bool, optional): False for models whose inference code cannot take bfloat16 weights;
+            they fall back to int8 in bf16 mode. Defaults to True.
+    Returns:
+        torch.nn.Module: The model to use for inference, in eval mode.
+    Raises:
+        ValueError: If `mode` is not one of `INFERENCE_MODES`.
+    """
+
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f"Unknown inference mode: {mode}")
+    model.eval()
+    if mode == "fp32" or torch.device(device).type != "cpu":
+        return model
+    if mode == "bf16" and allow_bf16 and bf16_supported():
+        return model.to(torch.bfloat16)
+    if mode == "bf16":
+        print(f"- bf16 is not available for {type(model).__name__}, using int8 instead")
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def model_dtype(model):
+    """
+    Returns the floating point dtype inputs such as pixel values must be cast to for the given model.
+    """
+
+    for parameter in model.parameters():
+        if parameter.is_floating_point():
+            return parameter.dtype
+    return torch.float32
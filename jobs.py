@@ -0,0 +1,161 @@
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import metrics
+import tracing
+
+load_dotenv()
+# Jobs running at the same time; more are queued up to JOB_MAX_PENDING, then refused
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", 100))
+# Seconds a finished job stays available for polling
+JOB_TTL = float(os.getenv("JOB_TTL", 600))
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    One run of a pipeline, whose events can be polled or streamed while it runs.
+    Events are appended by the worker thread and never removed, so every reader can follow them from any position.
+    The last event of a job is always {"type": "done"} or {"type": "error", "error": ...}.
+    Attributes:
+        id (str): The job id.
+        key (str): The input the job was deduplicated on, e.g. the URL.
+        trace_id (str): The id of the trace the job's spans are recorded under.
+        status (str): "queued", "running", "done" or "failed".
+        events (list): The events produced so far, each a JSON-serializable dict with a "type".
+        error (str or None): The error message if the job failed.
+        created_at (float): When the job was submitted.
+        finished_at (float or None): When the job finished.
+    Methods:
+        wait(cursor, timeout): Waits, without blocking the event loop, until there are more than `cursor` events.
+    """
+
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.trace_id = tracing.new_id()
+        self.status = "queued"
+        self.events = []
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def add_event(self, event):
+        with self._lock:
+            self.events.append(event)
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    def finish(self, error=None):
+        self.error = error
+        self.finished_at = time.time()
+        self.status = "failed" if error is not None else "done"
+        self.add_event({"type": "error", "error": error} if error is not None else {"type": "done"})
+
+    async def wait(self, cursor, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if len(self.events) > cursor:
+                return
+            self._waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "trace_id": self.trace_id,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "events": list(self.events),
+        }
+
+
+class JobManager:
+    """
+    Runs pipelines as background jobs, deduplicated by key while in flight.
+    A job submitted for a key that already has a queued or running job gets that job back, so clients asking
+    about the same URL at the same time share one pipeline run.
+    Jobs are held in this process's memory only, so every request about a job must reach the process running it.
+    Attributes:
+        run (callable): Generator function taking the key and yielding the job's events.
+        jobs (dict): Known jobs by id; finished jobs are forgotten `ttl` seconds after they finish.
+    Methods:
+        submit(key): Returns the in-flight job for `key`, or starts a new one.
+        get(job_id): Returns a job, or None if it is unknown or expired.
+    """
+
+    def __init__(self, run, max_workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, ttl=JOB_TTL):
+        self.run = run
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+
+    def submit(self, key):
+        """
+        Args:
+            key (str): The pipeline input, e.g. the URL to analyze.
+        Returns:
+            tuple: The Job, and True if it was already in flight for this key.
+        Raises:
+            JobQueueFull: If `max_pending` jobs are already queued or running.
+        """
+
+        with self._lock:
+            self._expire()
+            job = self._active.get(key)
+            if job is not None:
+                return job, True
+            if len(self._active) >= self.max_pending:
+                raise JobQueueFull(f"{len(self._active)} jobs already in flight")
+            job = Job(key)
+            self.jobs[job.id] = job
+            self._active[key] = job
+        self._pool.submit(self._execute, job)
+        return job, False
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _execute(self, job):
+        job.status = "running"
+        error = None
+        try:
+            with tracing.attach((job.trace_id, None)), metrics.track_request("job"):
+                for event in self.run(job.key):
+                    job.add_event(event)
+        except Exception as e:
+            print(f"- Job {job.id} for {job.key} failed: {e}")
+            error = str(e)
+        with self._lock:
+            self._active.pop(job.key, None)
+        job.finish(error)
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and now - job.finished_at > self.ttl]:
+            del self.jobs[job_id]
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import random
+import threading
+import metrics
+from dotenv import load_dotenv
+
+load_dotenv()
+# "gemini" calls the Gemini API, "stub" answers locally from the response schema (for offline testing)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF = float(os.getenv("LLM_BACKOFF", 0.5))
+
+
+class GeminiBackend:
+    """
+    Backend calling the Gemini API with one stateless `generate_content` request per call.
+    A GenerativeModel is built once per task and reused, so its underlying client connection is shared
+    by every call; no chat history is kept between calls.
+    """
+
+    name = "gemini"
+
+    def __init__(self):
+        import google.generativeai as genai
+        self.genai = genai
+        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+
+    def prepare(self, task):
+        return self.genai.GenerativeModel(
+            model_name=task["model_name"],
+            generation_config=task["generation_config"],
+            system_instruction=task["system_instruction"],
+        )
+
+    def call(self, prepared, task, prompt):
+        return prepared.generate_content(prompt).text
+
+
+class StubBackend:
+    """
+    Local backend that never touches the network.
+    By default it answers with a JSON object built from the task's response schema: booleans are false,
+    strings echo the prompt, numbers are 0 and arrays are empty. A `responder(task_name, prompt)` callable
+    can be given to return custom JSON-serializable answers instead.
+    """
+
+    name = "stub"
+
+    def __init__(self, responder=None):
+        self.responder = responder
+
+    def prepare(self, task):
+        return None
+
+    def call(self, prepared, task, prompt):
+        if self.responder is not None:
+            return json.dumps(self.responder(task["name"], prompt))
+        return json.dumps(stub_value(task["generation_config"].get("response_schema"), prompt))
+
+
+def stub_value(schema, prompt):
+    if schema is None:
+        return prompt
+    if isinstance(schema, dict):
+        kind, properties, items = schema.get("type"), schema.get("properties", {}), schema.get("items")
+    else:
+        kind, properties, items = schema.type, schema.properties, getattr(schema, "items", None)
+    kind = getattr(kind, "name", str(kind)).upper()
+    if kind == "OBJECT":
+        return {key: stub_value(value, prompt) for key, value in properties.items()}
+    if kind == "ARRAY":
+        return []
+    if kind == "BOOLEAN":
+        return False
+    if kind in ("INTEGER", "NUMBER"):
+        return 0
+    return prompt
+
+
+def make_backend(name):
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"Unknown LLM backend: {name}")
+
+
+class LLMGateway:
+    """
+    Shared gateway for every LLM call in the pipeline.
+    Each call is a stateless, structured request, so nothing from one user's content leaks into another's context
+    and request size does not grow over the process lifetime. Calls are limited to `max_concurrency` at a time
+    and retried with exponential backoff and jitter.
+    Attributes:
+        backend (GeminiBackend or StubBackend): The backend executing the calls.
+        tasks (dict): Registered tasks by name, each with its model name, generation config and system instruction.
+        max_retries (int): Number of retries after a failed call.
+        backoff (float): Base delay in seconds between retries; doubled after each attempt.
+    Methods:
+        register(name, model_name, generation_config, system_instruction): Registers a task.
+        generate(name, prompt): Returns the raw response text of a task.
+        generate_json(name, prompt): Returns the parsed JSON response of a task.
+        stats(): Returns per-task call counts, failures, retries and latencies.
+    """
+
+    def __init__(self, backend=None, max_concurrency=LLM_MAX_CONCURRENCY, max_retries=LLM_MAX_RETRIES, backoff=LLM_BACKOFF):
+        self._backend = backend
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.tasks = {}
+        self._prepared = {}
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = make_backend(LLM_BACKEND)
+            return self._backend
+
+    def set_backend(self, backend):
+        with self._lock:
+            self._backend = backend
+            self._prepared.clear()
+
+    def register(self, name, model_name, generation_config, system_instruction):
+        with self._lock:
+            self.tasks[name] = {
+                "name": name,
+                "model_name": model_name,
+                "generation_config": generation_config,
+                "system_instruction": system_instruction,
+            }
+            self._prepared.pop(name, None)
+            self._metrics.setdefault(name, {"calls": 0, "failures": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+
+    def _prepare(self, name):
+        backend = self.backend
+        with self._lock:
+            if name not in self._prepared:
+                self._prepared[name] = backend.prepare(self.tasks[name])
+            return backend, self._prepared[name]
+
+    def generate(self, name, prompt):
+        task = self.tasks[name]
+        backend, prepared = self._prepare(name)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                with self._slots:
+                    text = backend.call(prepared, task, prompt)
+                self._record(name, time.perf_counter() - start, attempt)
+                return text
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    self._record(name, time.perf_counter() - start, attempt, failed=True)
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                print(f"- LLM call for {name} failed ({e}), retrying in {delay:.2f} seconds...")
+                time.sleep(delay)
+                attempt += 1
+
+    def generate_json(self, name, prompt):
+        return json.loads(self.generate(name, prompt))
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for name, metrics in self._metrics.items():
+                stats[name] = dict(metrics)
+                stats[name]["avg_seconds"] = metrics["total_seconds"] / metrics["calls"] if metrics["calls"] else 0.0
+            return stats
+
+    def _record(self, name, seconds, retries, failed=False):
+        with self._lock:
+            task_metrics = self._metrics[name]
+            task_metrics["calls"] += 1
+            task_metrics["retries"] += retries
+            task_metrics["failures"] += int(failed)
+            task_metrics["total_seconds"] += seconds
+            task_metrics["max_seconds"] = max(task_metrics["max_seconds"], seconds)
+        metrics.LLM_CALLS.inc(task=name, outcome="error" if failed else "ok")
+        if retries:
+            metrics.LLM_RETRIES.inc(retries, task=name)
+        if not failed:
+            metrics.LLM_SECONDS.observe(seconds, task=name)
+
+
+gateway = LLMGateway()
@@ -0,0 +1,201 @@
+"""
+Minimal Prometheus instrumentation: counters, gauges and histograms rendered in the text exposition format.
+Metrics are per process. Work done in the video worker processes is recorded with `capture()` there and
+applied to the parent's metrics with `replay()`. Stages and requests are also recorded as spans of the current trace.
+"""
+import time
+import threading
+import tracing
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_capture = threading.local()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metric types: a named family of values, one per combination of label values.
+    With `fn`, the values are read when the metrics are rendered instead: `fn()` returns a list of
+    `(labels dict, value)` pairs, which suits values owned by other objects, such as queue depths or cache counters.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+        with _metrics_lock:
+            if name in _metrics:
+                raise ValueError(f"Metric {name} is already registered")
+            _metrics[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def _record(self, method, value, labels):
+        events = getattr(_capture, "events", None)
+        if events is not None:
+            events.append((self.name, method, value, labels))
+
+    def samples(self):
+        if self.fn is not None:
+            return [("", self._key(labels), value) for labels, value in self.fn()]
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._record("inc", amount, labels)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+        self._record("observe", value, labels)
+
+    def totals(self):
+        """
+        Returns `(count, sum)` of the observations of each combination of label values, keyed by the label values.
+        """
+
+        with self._lock:
+            return {tuple(value for _, value in key): (counts[-1], total) for key, (counts, total) in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", key + (("le", "+Inf" if bound == float("inf") else str(bound)),), count))
+                samples.append(("_sum", key, total))
+                samples.append(("_count", key, counts[-1]))
+        return samples
+
+
+def render():
+    """
+    Returns every registered metric in the Prometheus text exposition format.
+    """
+
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+@contextmanager
+def capture():
+    """
+    Records the counter increments and histogram observations made by the current thread, so they can be sent to
+    another process and applied there with `replay`. Yields the list the events are appended to.
+    """
+
+    events = []
+    _capture.events = events
+    try:
+        yield events
+    finally:
+        _capture.events = None
+
+def replay(events):
+    for name, method, value, labels in events:
+        getattr(_metrics[name], method)(value, **labels)
+
+
+STAGE_SECONDS = Histogram("moderation_stage_seconds", "Time spent in each pipeline stage", ["stage"])
+REQUESTS = Counter("moderation_requests_total", "Moderation requests by kind and outcome", ["kind", "outcome"])
+REQUEST_SECONDS = Histogram("moderation_request_seconds", "End to end latency of moderation requests", ["kind"])
+BATCH_SIZE = Histogram("engine_batch_size", "Items per batch handed to a batch engine", ["engine"], buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+BATCH_SECONDS = Histogram("engine_batch_seconds", "Time a batch engine spends on one batch", ["engine"])
+LLM_CALLS = Counter("llm_calls_total", "LLM calls by task and outcome", ["task", "outcome"])
+LLM_RETRIES = Counter("llm_retries_total", "LLM call retries by task", ["task"])
+LLM_SECONDS = Histogram("llm_call_seconds", "Latency of successful LLM calls", ["task"])
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a block as the pipeline stage `name` and records it as a span of the current trace:
+    `with metrics.stage("tokenize"): ...`
+    """
+
+    with STAGE_SECONDS.time(stage=name), tracing.span(name):
+        yield
+
+@contextmanager
+def track_request(kind):
+    """
+    Counts a moderation request and times it end to end, recording whether it raised.
+    The request is the root span of a new trace, unless it runs inside one already.
+    """
+
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        with tracing.span(kind, root=True):
+            yield
+        outcome = "ok"
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, kind=kind)
+        REQUESTS.inc(kind=kind, outcome=outcome)
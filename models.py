@@ -0,0 +1,82 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+# Comma separated model names loaded by `warmup()` at startup, or "all"; the rest load on first use
+WARMUP_MODELS = os.getenv("WARMUP_MODELS", "")
+
+
+class ModelRegistry:
+    """
+    Loads each model on first use instead of at import time, so a process only pays for the models it needs.
+    Models are registered with a loader function and loaded at most once, even when several threads ask for
+    the same model at the same time; loading different models does not block each other.
+    Attributes:
+        loaders (dict): Registered loader functions by model name.
+    Methods:
+        register(name, loader): Registers a model.
+        get(name): Returns the model, loading it if needed.
+        warmup(names=None): Loads the given models (all registered models if None) ahead of the first request.
+        stats(): Returns which models are loaded and how long each took to load.
+    """
+
+    def __init__(self):
+        self.loaders = {}
+        self._models = {}
+        self._load_seconds = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        with self._lock:
+            self.loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._locks[name]:
+            if name not in self._models:
+                print(f"- Loading {name} model...")
+                start = time.perf_counter()
+                self._models[name] = self.loaders[name]()
+                self._load_seconds[name] = time.perf_counter() - start
+                print(f"- Loaded {name} model in {self._load_seconds[name]:.2f} seconds")
+            return self._models[name]
+
+    def warmup(self, names=None):
+        """
+        Loads models before they are first needed.
+        Args:
+            names (list or str, optional): Model names, a comma separated string of them, or "all". Defaults to all registered models.
+        Returns:
+            dict: The load time in seconds of each requested model (0 for models that were already loaded).
+        Raises:
+            KeyError: If a name is not registered.
+        """
+
+        timings = {}
+        for name in self.resolve(names):
+            loaded = name in self._models
+            self.get(name)
+            timings[name] = 0.0 if loaded else self._load_seconds[name]
+        return timings
+
+    def resolve(self, names=None):
+        """
+        Returns the model names given as a list, a comma separated string, or "all" / None for every registered model.
+        """
+
+        if isinstance(names, str):
+            names = None if names.strip() == "all" else [name.strip() for name in names.split(",") if name.strip()]
+        return list(self.loaders) if names is None else list(names)
+
+    def stats(self):
+        with self._lock:
+            return {name: {"loaded": name in self._models, "load_seconds": self._load_seconds.get(name)} for name in self.loaders}
+
+
+registry = ModelRegistry()
@@ -1,11 +1,9 @@
-import os
 # import subprocess
-from dotenv import load_dotenv
-import google.generativeai as genai
+import metrics
+from llm_gateway import gateway
 from google.ai.generativelanguage_v1beta.types import content
 
-load_dotenv()
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+GEMINI_MODEL = "gemini-1.5-flash"
 
 # config for gemini model for video transcription 
 generation_config1 = {
@@ -28,12 +26,12 @@ generation_config1 = {
   ),
   "response_mime_type": "application/json",
 }
-model1 = genai.GenerativeModel(
-  model_name="gemini-1.5-flash",
+gateway.register(
+  "video_verdict",
+  model_name=GEMINI_MODEL,
   generation_config=generation_config1,
   system_instruction="user will provide a summarised version of an news article. Tell if it's factual or fake, and if it's factual, then tell if it's opiniated or not.",
 )
-chat_session1 = model1.start_chat()
 
 # config for gemini model for news article fakery detection
 generation_config2 = {
@@ -60,44 +58,43 @@ generation_config2 = {
   "response_mime_type": "application/json",
 }
 
-model2 = genai.GenerativeModel(
-  model_name="gemini-1.5-flash",
+gateway.register(
+  "article_verdict",
+  model_name=GEMINI_MODEL,
   generation_config=generation_config2,
   system_instruction="tell if the given URL is an article (blog , news) or non article web page. And if it is an article, then tell if its fake , real or opinionated.",
 )
 
-chat_session2 = model2.start_chat()
-
+@metrics.stage("article_verdict")
 def fake_news_detector(text):
     """
     Detects if the given news article text is fake or real.
-    This function sends the provided text to a chat session for analysis
+    This function sends the provided text to the LLM gateway as a stateless request
     and returns the result indicating whether the news article is fake or real.
     Args:
       text (str): The news article text to be analyzed.
     Returns:
-      str: The result from the chat session indicating if the news is fake or real in JSON.
+      str: The result from the gateway indicating if the news is fake or real in JSON.
     """
     
     print("- Detecting if the news article is fake or real...")
     # subprocess.run(["echo", "- Detecting if the news article is fake or real..."])
-    response = chat_session2.send_message(text)
-    result = response.text
+    result = gateway.generate("article_verdict", text)
     return result
 
+@metrics.stage("video_verdict")
 def fake_video_detector(text):
     """
     Detects if the video described by the given text is fake or real.
-    This function sends the provided text to a chat session for analysis and 
+    This function sends the provided text to the LLM gateway as a stateless request and 
     returns the result indicating whether the video is fake or real.
     Args:
       text (str): The transcription of the video to be analyzed.
     Returns:
-      str: The result from the chat session indicating if the video is fake or real in JSON.
+      str: The result from the gateway indicating if the video is fake or real in JSON.
     """
     
     print("- Detecting if the video is fake or real...")
     # subprocess.run(["echo", "- Detecting if the video is fake or real..."])
-    response = chat_session1.send_message(text)
-    result = response.text
+    result = gateway.generate("video_verdict", text)
     return result
\ No newline at end of file
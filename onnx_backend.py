@@ -0,0 +1,185 @@
+"""
+ONNX Runtime backend for the hate-speech and NSFW classifiers.
+Export the graphs once, then run with CLASSIFIER_BACKEND=onnx:
+    python onnx_backend.py export
+    python onnx_backend.py parity
+"""
+import os
+import json
+import glob
+import argparse
+import importlib.util
+import torch
+from dotenv import load_dotenv
+from inference_mode import INFERENCE_MODE
+
+load_dotenv()
+# "torch" runs the classifiers in eager PyTorch, "onnx" runs the exported graphs with ONNX Runtime
+CLASSIFIER_BACKEND = os.getenv("CLASSIFIER_BACKEND", "torch")
+ONNX_DIR = os.getenv("ONNX_DIR", "onnx_models")
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", os.cpu_count() or 1))
+ORT_INTER_OP_THREADS = int(os.getenv("ORT_INTER_OP_THREADS", 1))
+OPSET = 17
+
+
+class OnnxClassifier:
+    """
+    A classifier graph loaded into an ONNX Runtime CPU session.
+    Attributes:
+        session (onnxruntime.InferenceSession): The session, tuned with `ORT_INTRA_OP_THREADS` / `ORT_INTER_OP_THREADS`.
+        input_names (list): Names of the graph inputs; other inputs passed to `logits` are ignored.
+    Methods:
+        logits(**inputs): Runs the graph on torch tensors and returns the logits as a torch tensor.
+    """
+
+    def __init__(self, path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = ORT_INTRA_OP_THREADS
+        options.inter_op_num_threads = ORT_INTER_OP_THREADS
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def logits(self, **inputs):
+        feed = {name: inputs[name].detach().cpu().numpy() for name in self.input_names}
+        return torch.from_numpy(self.session.run(["logits"], feed)[0])
+
+
+def onnx_path(name):
+    return os.path.join(ONNX_DIR, f"{name}.onnx")
+
+def classifier_tag(name, backend=CLASSIFIER_BACKEND):
+    """
+    Returns what the classifier `name` runs with, following the same fallbacks as `load_classifier` without loading
+    anything: "onnx", or the PyTorch inference mode. Cached verdicts are keyed by it, so switching INFERENCE_MODE or
+    CLASSIFIER_BACKEND never serves verdicts computed by another variant of the model.
+    """
+
+    if backend == "onnx" and os.path.exists(onnx_path(name)) and importlib.util.find_spec("onnxruntime") is not None:
+        return "onnx"
+    return INFERENCE_MODE
+
+def load_classifier(name, backend=CLASSIFIER_BACKEND):
+    """
+    Loads the ONNX graph of a classifier if the ONNX backend is selected.
+    Args:
+        name (str): "text" or "image".
+        backend (str, optional): The configured backend. Defaults to `CLASSIFIER_BACKEND`.
+    Returns:
+        OnnxClassifier or None: The loaded classifier, or None when the caller should use eager PyTorch, i.e. when the
+        backend is "torch", onnxruntime is not installed or the graph has not been exported.
+    """
+
+    if backend != "onnx":
+        return None
+    path = onnx_path(name)
+    if not os.path.exists(path):
+        print(f"- {path} not found, run `python onnx_backend.py export`; using PyTorch for the {name} classifier")
+        return None
+    try:
+        return OnnxClassifier(path)
+    except ImportError:
+        print(f"- onnxruntime is not installed; using PyTorch for the {name} classifier")
+        return None
+
+def export_text_model(model, tokenizer, path):
+    inputs = tokenizer(["An example sentence.", "Another, slightly longer example sentence."], padding=True, return_tensors="pt")
+    torch.onnx.export(
+        model, (inputs["input_ids"], inputs["attention_mask"]), path,
+        input_names=["input_ids", "attention_mask"], output_names=["logits"],
+        dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "logits": {0: "batch"}},
+        opset_version=OPSET,
+    )
+
+def export_image_model(model, path):
+    size = model.config.image_size
+    torch.onnx.export(
+        model, (torch.zeros(2, 3, size, size),), path,
+        input_names=["pixel_values"], output_names=["logits"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=OPSET,
+    )
+
+def reference_model(name):
+    """
+    Loads the eager fp32 PyTorch model of the classifier `name` ("text" or "image") straight from its checkpoint.
+    The model registry is bypassed, since it applies INFERENCE_MODE and CLASSIFIER_BACKEND, which are read when
+    this module is imported and so cannot be overridden from here.
+    """
+
+    from transformers import AutoModelForImageClassification, AutoModelForSequenceClassification
+    if name == "text":
+        from text_model import location
+        return AutoModelForSequenceClassification.from_pretrained(location).eval()
+    from image_model import MODEL
+    return AutoModelForImageClassification.from_pretrained(MODEL).eval()
+
+def export(names):
+    from transformers import AutoTokenizer
+    from text_model import location
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    if "text" in names:
+        export_text_model(reference_model("text"), AutoTokenizer.from_pretrained(location), onnx_path("text"))
+        print(f"- Exported the hate speech classifier to {onnx_path('text')}")
+    if "image" in names:
+        export_image_model(reference_model("image"), onnx_path("image"))
+        print(f"- Exported the NSFW classifier to {onnx_path('image')}")
+
+def parity(sentences_path, images_dir, tolerance):
+    """
+    Runs the same fixtures through the ONNX graphs and the eager fp32 models and checks that labels match and logits
+    stay within `tolerance`.
+    Returns:
+        bool: True if both classifiers agree on every sample.
+    """
+
+    from PIL import Image, UnidentifiedImageError
+    from transformers import AutoTokenizer, ViTImageProcessor
+    from text_model import location
+    from image_model import MODEL
+    ok = True
+    with open(sentences_path) as f:
+        sentences = [json.loads(line)["text"] for line in f if line.strip()]
+    inputs = AutoTokenizer.from_pretrained(location)(sentences, padding=True, truncation=True, return_tensors="pt")
+    processor = ViTImageProcessor.from_pretrained(MODEL)
+    pixel_values = []
+    for path in sorted(glob.glob(os.path.join(images_dir, "*"))):
+        try:
+            image = Image.open(path).convert("RGB")
+        except (UnidentifiedImageError, OSError):
+            continue
+        pixel_values.append(processor(images=image, return_tensors="pt")["pixel_values"][0])
+    cases = [("text", {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]})]
+    if pixel_values:
+        cases.append(("image", {"pixel_values": torch.stack(pixel_values)}))
+    for name, feed in cases:
+        with torch.no_grad():
+            expected = reference_model(name)(**feed).logits.float()
+        actual = OnnxClassifier(onnx_path(name)).logits(**feed).float()
+        difference = (expected - actual).abs().max().item()
+        mismatches = (expected.argmax(-1) != actual.argmax(-1)).sum().item()
+        passed = mismatches == 0 and difference <= tolerance
+        ok = ok and passed
+        print(f"{name}: {'ok' if passed else 'FAILED'}, {mismatches} label mismatches over {len(expected)} samples, max logit difference {difference:.2e}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Export the classifiers to ONNX_DIR")
+    export_parser.add_argument("--models", nargs="+", choices=["text", "image"], default=["text", "image"])
+    parity_parser = commands.add_parser("parity", help="Compare the ONNX graphs against eager PyTorch on the fixtures")
+    parity_parser.add_argument("--sentences", default=os.path.join("fixtures", "sentences.jsonl"))
+    parity_parser.add_argument("--images", default=os.path.join("fixtures", "images"))
+    parity_parser.add_argument("--tolerance", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.models)
+    elif not parity(args.sentences, args.images, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
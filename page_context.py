@@ -0,0 +1,86 @@
+import os
+import time
+import threading
+import requests
+import metrics
+from bs4 import BeautifulSoup
+
+# Downloaded pages are reused for this many seconds, so one "Analyze URL" run fetches its page once
+PAGE_TTL = float(os.getenv("PAGE_CACHE_TTL", 60))
+PAGE_CACHE_SIZE = 64
+
+session = requests.Session()
+_pages = {}
+_pages_lock = threading.Lock()
+
+
+class PageContext:
+    """
+    A downloaded web page shared by every consumer of one request.
+    The document is parsed at most once. Right after parsing, the parts read by the YouTube extraction and the
+    audio summary are captured, so `scrape_content` can then modify `soup` in place without affecting them.
+    Attributes:
+        url (str): The URL of the page.
+        content (bytes): The raw HTML body.
+        soup (BeautifulSoup): The parsed document, created on first access.
+        paragraphs (list): Text of every <p> element, as found in the unmodified document.
+        iframe_sources (list): `src` of every <iframe> element, as found in the unmodified document.
+    """
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+        self._soup = None
+        self._lock = threading.Lock()
+
+    @property
+    def soup(self):
+        with self._lock:
+            if self._soup is None:
+                print("- Parsing page...")
+                with metrics.stage("parse_page"):
+                    self._soup = BeautifulSoup(self.content, 'html.parser', from_encoding='utf-8')
+                    self._paragraphs = [para.text for para in self._soup.find_all('p')]
+                    self._iframe_sources = [iframe.get('src', '') for iframe in self._soup.find_all('iframe')]
+            return self._soup
+
+    @property
+    def paragraphs(self):
+        self.soup
+        return self._paragraphs
+
+    @property
+    def iframe_sources(self):
+        self.soup
+        return self._iframe_sources
+
+
+def get_page(url):
+    """
+    Returns a PageContext for the given URL, downloading it only if it was not fetched in the last `PAGE_TTL` seconds.
+    Every call returns a fresh PageContext, so a document modified by one request is never seen by another;
+    only the downloaded bytes are shared.
+    Args:
+        url (str): The URL of the page.
+    Returns:
+        PageContext: The page, ready to be parsed.
+    Raises:
+        requests.exceptions.RequestException: If there is an error fetching the content from the URL.
+    """
+
+    now = time.time()
+    with _pages_lock:
+        cached = _pages.get(url)
+        if cached is not None and now - cached[0] < PAGE_TTL:
+            return PageContext(url, cached[1])
+    print("- Fetching page...")
+    with metrics.stage("fetch_page"):
+        response = session.get(url, timeout=10)
+        response.raise_for_status()
+    with _pages_lock:
+        _pages[url] = (now, response.content)
+        for stale in [key for key, (fetched_at, _) in _pages.items() if now - fetched_at >= PAGE_TTL]:
+            del _pages[stale]
+        while len(_pages) > PAGE_CACHE_SIZE:
+            del _pages[next(iter(_pages))]
+    return PageContext(url, response.content)
@@ -0,0 +1,184 @@
+"""
+Cheap first stage of the hate speech cascade. A small logistic regression estimates the probability that a sentence
+is hate speech from lexicon and n-gram features: the lexicon terms it contains (terms naming a targeted group and
+abusive or dehumanizing terms, found in one pass with an Aho-Corasick automaton), their total weight, and its words
+and pairs of consecutive words. Sentences whose calibrated P(hate) is below the threshold are labelled "nothate"
+with the score 1 - P(hate) and never reach RoBERTa; the others are classified by the model as before.
+The weights, the calibration and the threshold are fitted by `python prefilter_calibration.py` on labelled sentences:
+the weights on a training set, then the calibration (Platt scaling) and the highest threshold within the allowed
+recall loss on held-out sentences. It saves them to a JSON file, which PREFILTER_MODEL points to. The pre-filter is
+off by default and cannot be enabled without such a file; fit it on a labelled sample of your own traffic, the
+fixtures are far too small for the probabilities to be trusted.
+"""
+import os
+import re
+import json
+import math
+from collections import deque
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+# "off" sends every sentence to the model, "linear" enables the pre-filter
+PREFILTER = os.getenv("PREFILTER", "off")
+# JSON file written by prefilter_calibration.py, required with PREFILTER=linear
+PREFILTER_MODEL = os.getenv("PREFILTER_MODEL")
+# P(hate) below which sentences are cleared. Defaults to the threshold chosen by the calibration, saved in PREFILTER_MODEL
+PREFILTER_THRESHOLD = float(os.getenv("PREFILTER_THRESHOLD")) if os.getenv("PREFILTER_THRESHOLD") else None
+# Extra `{"term": weight}` lexicon entries used when fitting the pre-filter
+PREFILTER_LEXICON = os.getenv("PREFILTER_LEXICON")
+
+TARGET, ABUSE, SEVERE = 1, 1, 2
+# Terms match at the start of a word, so "immigrant" also matches "immigrants"
+TERMS = {
+    **dict.fromkeys([
+        "people", "immigrant", "migrant", "refugee", "foreigner", "women", "woman", "girls", "men ", "muslim",
+        "islam", "jew", "christian", "hindu", "sikh", "black", "white", "asian", "arab", "mexican", "african",
+        "chinese", "gay", "lesbian", "trans", "queer", "homosexual", "disabled", "retard", "old people", "elderly",
+        "gypsies", "gypsy", "race", "they ", "them ", "those ", "you ", "your kind",
+    ], TARGET),
+    **dict.fromkeys([
+        "hate", "stupid", "idiot", "moron", "dumb", "ugly", "disgust", "useless", "worthless", "burden", "freak",
+        "criminal", "terrorist", "thug", "savage", "inferior", "ruin", "destroy", "kick out", "deport",
+        "lock them", "die", "dead", "shut up",
+        "trash", "garbage", "scum", "pathetic", "sick", "evil", "ban ",
+    ], ABUSE),
+    **dict.fromkeys([
+        "vermin", "parasite", "animals", "filth", "subhuman", "infest", "cockroach", "rats", "plague", "wipe",
+        "wiped out", "extermin", "kill", "gas them", "lynch", "hang them", "shoot them", "burn them", "genocide",
+    ], SEVERE),
+}
+NON_WORD = re.compile(r"[^\w']+")
+WORD = re.compile(r"[\w']+")
+PREFILTER_DECISIONS = metrics.Counter("prefilter_decisions_total", "Sentences cleared by the pre-filter or sent on to the classifier", ["decision"])
+
+
+def sigmoid(z):
+    return 1 / (1 + math.exp(-z)) if z >= 0 else math.exp(z) / (1 + math.exp(z))
+
+
+class AhoCorasick:
+    """
+    Finds every occurrence of a set of terms in one pass over the text, however many terms there are.
+    Methods:
+        find(text): Yields `(start, term)` for every occurrence of a term in `text`.
+    """
+
+    def __init__(self, terms):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for term in terms:
+            state = 0
+            for char in term:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(term)
+        # Breadth first, so the failure state of a node is always built before the node itself
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self.goto[state].items():
+                pending.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for term in self.output[state]:
+                yield i - len(term) + 1, term
+
+
+class Prefilter:
+    """
+    Logistic regression over the lexicon and n-gram features of a sentence, with Platt scaling on its output.
+    Attributes:
+        terms (dict): Weight of each lowercase lexicon term.
+        weights (dict): Weight of each feature; features without one are ignored.
+        bias (float): The intercept.
+        calibration (tuple): `(a, b)` of the Platt scaling, P(hate) = sigmoid(a * z + b) of the raw score z.
+        threshold (float): Sentences whose P(hate) is below it are cleared.
+    Methods:
+        features(text): Returns the features of `text` as a `{name: value}` dict.
+        score(text): Returns the raw, uncalibrated score of `text`.
+        hate_probability(text): Returns the calibrated probability that `text` is hate speech.
+        clears(probability): Whether a sentence with this P(hate) can be labelled "nothate" without the model.
+        to_dict(): Returns everything needed to rebuild the pre-filter, as saved in PREFILTER_MODEL.
+    """
+
+    def __init__(self, terms, weights=None, bias=0.0, calibration=(1.0, 0.0), threshold=0.0):
+        self.terms = {term.lower(): weight for term, weight in terms.items()}
+        self.weights = weights or {}
+        self.bias = bias
+        self.calibration = tuple(calibration)
+        self.threshold = threshold
+        self.automaton = AhoCorasick(self.terms)
+
+    def features(self, text):
+        # Punctuation and runs of whitespace become single spaces, and spaces around the text let terms ending
+        # with a space match at its end, e.g. "them "
+        normalized = " " + NON_WORD.sub(" ", text.lower()).strip() + " "
+        found = {term for start, term in self.automaton.find(normalized) if not normalized[start - 1].isalnum()}
+        words = WORD.findall(normalized)
+        features = {"lexicon": sum(self.terms[term] for term in found)}
+        features.update((f"term:{term}", 1) for term in found)
+        features.update((f"word:{word}", 1) for word in words)
+        features.update((f"pair:{first} {second}", 1) for first, second in zip(words, words[1:]))
+        return features
+
+    def score(self, text):
+        return self.bias + sum(self.weights.get(name, 0.0) * value for name, value in self.features(text).items())
+
+    def hate_probability(self, text):
+        a, b = self.calibration
+        return sigmoid(a * self.score(text) + b)
+
+    def clears(self, probability):
+        cleared = probability < self.threshold
+        PREFILTER_DECISIONS.inc(decision="cleared" if cleared else "escalated")
+        return cleared
+
+    def to_dict(self):
+        return {"terms": self.terms, "weights": self.weights, "bias": self.bias, "calibration": list(self.calibration),
+                "threshold": self.threshold}
+
+
+def load_lexicon(path=PREFILTER_LEXICON):
+    """
+    Returns the built-in terms, extended or overridden by the `{"term": weight}` JSON file at `path`, if given.
+    """
+
+    terms = dict(TERMS)
+    if path:
+        with open(path) as f:
+            terms.update(json.load(f))
+    return terms
+
+def load_prefilter(path=PREFILTER_MODEL, threshold=PREFILTER_THRESHOLD):
+    """
+    Loads a pre-filter saved by prefilter_calibration.py, with its calibrated threshold unless `threshold` is given.
+    Raises:
+        ValueError: If no file is given.
+    """
+
+    if not path:
+        raise ValueError("PREFILTER=linear needs PREFILTER_MODEL, fit it with `python prefilter_calibration.py --output <file>`")
+    with open(path) as f:
+        saved = json.load(f)
+    return Prefilter(saved["terms"], saved["weights"], saved["bias"], saved["calibration"],
+                     saved["threshold"] if threshold is None else threshold)
+
+if PREFILTER not in ("linear", "off"):
+    raise ValueError(f"PREFILTER must be 'linear' or 'off', got {PREFILTER!r}")
+prefilter = load_prefilter() if PREFILTER == "linear" else None
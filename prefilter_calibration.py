@@ -0,0 +1,165 @@
+"""
+Fits and calibrates the pre-filter in front of the RoBERTa hate speech classifier (see `prefilter`).
+The logistic regression is trained on a first set of labelled sentences. Its scores on a second, held-out set are then
+calibrated with Platt scaling, and the threshold on the calibrated P(hate) is set as high as the allowed recall loss
+on that set permits. For that threshold and a few others, reports how many held-out sentences are cleared (and so how
+many classifier calls are saved), the recall lost against the full model and against the labels, the P(hate) given
+to the cleared sentences against how many of them were hateful, and the hateful sentences that would be cleared.
+With the model, the targets are RoBERTa's own labels, so the pre-filter learns which sentences the model would flag;
+with --no-model, they are the labels of the files.
+The held-out sentences must not have been used to write the lexicon or to train the weights: the default
+fixtures/prefilter_holdout.jsonl was written separately from both. A few dozen sentences only show that the fit runs
+and how gross its misses are; fit it on labelled samples of real traffic before enabling it with
+PREFILTER=linear PREFILTER_MODEL=<output file>.
+Usage:
+    python prefilter_calibration.py --no-model
+    python prefilter_calibration.py --train traffic_train.jsonl --holdout traffic_holdout.jsonl --max-recall-loss 0.01 --output prefilter_model.json
+"""
+import os
+import json
+import argparse
+import numpy as np
+from prefilter import Prefilter, load_lexicon, PREFILTER_LEXICON
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def read_sentences(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [record["text"] for record in records], [record.get("label") for record in records]
+
+def fit_logistic(rows, columns, values, targets, dimensions, l2=0.0, iterations=2000, learning_rate=0.5):
+    """
+    Fits a logistic regression by full batch gradient descent.
+    Args:
+        rows, columns, values (numpy.ndarray): The sparse feature matrix, as the row, column and value of each entry.
+        targets (numpy.ndarray): The target probability of each row.
+        dimensions (int): The number of columns.
+        l2 (float, optional): The L2 penalty on the weights. Defaults to none.
+    Returns:
+        tuple: The weights and the bias.
+    """
+
+    weights = np.zeros(dimensions)
+    bias = 0.0
+    for _ in range(iterations):
+        scores = bias + np.bincount(rows, weights=weights[columns] * values, minlength=len(targets))
+        errors = 1 / (1 + np.exp(-np.clip(scores, -30, 30))) - targets
+        gradient = np.bincount(columns, weights=errors[rows] * values, minlength=dimensions) / len(targets)
+        weights -= learning_rate * (gradient + l2 * weights)
+        bias -= learning_rate * errors.mean()
+    return weights, bias
+
+def train(prefilter, sentences, targets, l2, iterations):
+    columns = {}
+    entries = []
+    for row, sentence in enumerate(sentences):
+        for name, value in prefilter.features(sentence).items():
+            entries.append((row, columns.setdefault(name, len(columns)), value))
+    rows, indices, values = (np.array(values) for values in zip(*entries))
+    weights, bias = fit_logistic(rows, indices, values.astype(float), np.array(targets, dtype=float), len(columns), l2, iterations)
+    prefilter.weights = {name: float(weights[column]) for name, column in columns.items() if weights[column] != 0}
+    prefilter.bias = float(bias)
+
+def calibrate(scores, targets, iterations):
+    """
+    Platt scaling: fits P(hate) = sigmoid(a * score + b) on held-out scores and returns `(a, b)`.
+    """
+
+    positives = sum(targets)
+    negatives = len(targets) - positives
+    # Platt's smoothed targets keep a held-out set the scores separate perfectly from pushing P(hate) to exactly 0 or 1
+    smoothed = np.where(np.array(targets) == 1, (positives + 1) / (positives + 2), 1 / (negatives + 2))
+    (a,), b = fit_logistic(np.arange(len(scores)), np.zeros(len(scores), dtype=int), np.array(scores, dtype=float),
+                           smoothed, 1, iterations=iterations)
+    return float(a), float(b)
+
+def choose_threshold(probabilities, hateful, max_recall_loss):
+    """
+    Returns the highest threshold clearing at most `max_recall_loss` of the `hateful` sentences: the P(hate) of the
+    first hateful sentence, by increasing P(hate), that must still reach the model.
+    """
+
+    hate_probabilities = sorted(probabilities[i] for i in hateful)
+    allowed = int(max_recall_loss * len(hate_probabilities))
+    return hate_probabilities[allowed] if allowed < len(hate_probabilities) else 1.0
+
+def recall_loss(hateful, cleared):
+    return len(hateful & cleared) / len(hateful) if hateful else 0.0
+
+def evaluate(sentences, labels, model_labels, probabilities, threshold):
+    cleared = {i for i, probability in enumerate(probabilities) if probability < threshold}
+    reference = model_labels or labels
+    report = {
+        "threshold": threshold,
+        "cleared": len(cleared),
+        "cleared_fraction": len(cleared) / len(sentences),
+        "call_reduction": len(sentences) / max(1, len(sentences) - len(cleared)),
+        "recall_loss_vs_labels": recall_loss({i for i, label in enumerate(labels) if label == "hate"}, cleared),
+        # What the pre-filter reports for the cleared sentences, and how many of them were in fact hateful
+        "mean_cleared_probability": sum(probabilities[i] for i in cleared) / len(cleared) if cleared else 0.0,
+        "cleared_hate_rate": sum(reference[i] == "hate" for i in cleared) / len(cleared) if cleared else 0.0,
+        "missed": [sentences[i] for i in sorted(cleared) if reference[i] == "hate"],
+    }
+    if model_labels:
+        report["recall_loss_vs_model"] = recall_loss({i for i, label in enumerate(model_labels) if label == "hate"}, cleared)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--train", default=os.path.join(FIXTURES, "sentences.jsonl"),
+                        help="JSONL file with a 'text' and a 'label' per line, used to fit the weights")
+    parser.add_argument("--holdout", default=os.path.join(FIXTURES, "prefilter_holdout.jsonl"),
+                        help="JSONL file in the same format, not used to write the lexicon or fit the weights")
+    parser.add_argument("--lexicon", default=PREFILTER_LEXICON, help="JSON file of extra {term: weight}. Defaults to PREFILTER_LEXICON")
+    parser.add_argument("--max-recall-loss", type=float, default=0.0, help="Recall loss allowed on the held-out sentences")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.01, 0.05, 0.1, 0.2], help="Other P(hate) thresholds to report")
+    parser.add_argument("--l2", type=float, default=0.01, help="L2 penalty on the weights")
+    parser.add_argument("--iterations", type=int, default=2000, help="Gradient descent iterations")
+    parser.add_argument("--no-model", action="store_true", help="Train and compare against the labels only, without running RoBERTa")
+    parser.add_argument("--output", help="Write the fitted pre-filter and its report as JSON to this file, for PREFILTER_MODEL")
+    args = parser.parse_args()
+
+    train_sentences, train_labels = read_sentences(args.train)
+    sentences, labels = read_sentences(args.holdout)
+    train_targets, model_labels = train_labels, None
+    if not args.no_model:
+        import text_model
+        train_targets = [label for label, _ in text_model.classify_hate_speech(train_sentences, use_prefilter=False)]
+        model_labels = [label for label, _ in text_model.classify_hate_speech(sentences, use_prefilter=False)]
+        agreement = sum(a == b for a, b in zip(labels, model_labels)) / len(sentences)
+        print(f"RoBERTa agrees with {agreement:.1%} of the {len(sentences)} held-out labels")
+    reference = model_labels or labels
+
+    prefilter = Prefilter(load_lexicon(args.lexicon))
+    train(prefilter, train_sentences, [label == "hate" for label in train_targets], args.l2, args.iterations)
+    prefilter.calibration = calibrate([prefilter.score(sentence) for sentence in sentences],
+                                      [label == "hate" for label in reference], args.iterations)
+    probabilities = [prefilter.hate_probability(sentence) for sentence in sentences]
+    # The threshold is chosen on the sentences the calibration was fitted on, so its recall loss is optimistic
+    prefilter.threshold = choose_threshold(probabilities, [i for i, label in enumerate(reference) if label == "hate"],
+                                           args.max_recall_loss)
+
+    loss_key = "recall_loss_vs_model" if model_labels else "recall_loss_vs_labels"
+    chosen = evaluate(sentences, labels, model_labels, probabilities, prefilter.threshold)
+    reports = [evaluate(sentences, labels, model_labels, probabilities, threshold) for threshold in sorted(args.thresholds)]
+    print(f"Fitted {len(prefilter.weights)} weights on {len(train_sentences)} sentences, "
+          f"calibration a={prefilter.calibration[0]:.3f} b={prefilter.calibration[1]:.3f}")
+    for report in [chosen] + reports:
+        print(f"P(hate) < {report['threshold']:.4f}: clears {report['cleared']} of {len(sentences)} held-out sentences "
+              f"({report['call_reduction']:.1f}x fewer classifier calls), recall loss {report[loss_key]:.1%}"
+              + (f" vs model, {report['recall_loss_vs_labels']:.1%} vs labels" if model_labels else " vs labels")
+              + f"; mean P(hate) of cleared {report['mean_cleared_probability']:.3f}, observed {report['cleared_hate_rate']:.3f}")
+        for sentence in report["missed"]:
+            print(f"  missed: {sentence}")
+    print(f"Highest threshold within {args.max_recall_loss:.1%} recall loss on these {len(sentences)} sentences: "
+          f"PREFILTER_THRESHOLD={prefilter.threshold:.4f}, saved with the model")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({**prefilter.to_dict(), "reference": "model" if model_labels else "labels",
+                       "report": {"chosen": chosen, "reports": reports}}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
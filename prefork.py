@@ -0,0 +1,212 @@
+"""
+Preload-and-fork serving: the models are loaded once in a master process, which then forks the workers.
+The workers share the master's listening socket and its model weights, copy-on-write, so adding a worker
+costs its own working memory rather than another copy of every model.
+Limitations:
+- Classifiers running on ONNX Runtime (CLASSIFIER_BACKEND=onnx) are not preloaded, as ONNX Runtime sessions are
+  not fork-safe; each worker creates its own sessions on first use.
+- Videos are analyzed in a pool of VIDEO_WORKERS processes that each worker spawns (not forks) on first use, and
+  those load Whisper and the summarizer themselves. The preloaded copies are only used for the videos a worker
+  analyzes in-process, so up to PREFORK_WORKERS x VIDEO_WORKERS extra copies of them exist; the memory report
+  lists these processes as "video".
+Memory report of a running master and its workers (USS = memory unique to the process, PSS = its fair share of shared memory):
+    python prefork.py memory <master pid>
+or send SIGUSR1 to the master.
+"""
+import os
+import gc
+import sys
+import glob
+import signal
+import socket
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+# Number of forked workers; 0 serves from a single process without preloading
+PREFORK_WORKERS = int(os.getenv("PREFORK_WORKERS", 0))
+# Models loaded by the master before forking, see `models.ModelRegistry.warmup`. The ElevenLabs client is left out
+# by default, as it needs ELEVENLABS_API_KEY
+PREFORK_MODELS = os.getenv("PREFORK_MODELS", "hate_speech,nsfw,summarizer,whisper")
+# Registry names of the classifiers that can run on ONNX Runtime, with their `onnx_backend` names
+ONNX_CLASSIFIERS = {"hate_speech": "text", "nsfw": "image"}
+
+
+def listen(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def read_smaps_rollup(pid):
+    """
+    Reads the memory totals of a process from /proc/<pid>/smaps_rollup (Linux 4.14+).
+    Returns:
+        dict: Field name to size in bytes, e.g. "Rss", "Pss", "Private_Dirty".
+    """
+
+    sizes = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                sizes[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return sizes
+
+def child_pids(pid):
+    pids = []
+    for path in glob.glob(f"/proc/{pid}/task/*/children"):
+        with open(path) as f:
+            pids.extend(int(child) for child in f.read().split())
+    return pids
+
+def memory_report(pid=None):
+    """
+    Measures a master process, its workers and the video processes the workers spawned.
+    Args:
+        pid (int, optional): The master's process id. Defaults to the current process.
+    Returns:
+        list: A dict per process with its `pid`, `role` and its `rss`, `pss`, `uss` and `shared` sizes in bytes.
+    """
+
+    pid = pid or os.getpid()
+    processes = [("master", pid)]
+    for worker in child_pids(pid):
+        processes.append(("worker", worker))
+        try:
+            processes.extend(("video", child) for child in child_pids(worker))
+        except FileNotFoundError:
+            pass
+    rows = []
+    for role, process in processes:
+        try:
+            sizes = read_smaps_rollup(process)
+        except FileNotFoundError:
+            continue
+        rows.append({
+            "pid": process,
+            "role": role,
+            "rss": sizes.get("Rss", 0),
+            "pss": sizes.get("Pss", 0),
+            "uss": sizes.get("Private_Clean", 0) + sizes.get("Private_Dirty", 0),
+            "shared": sizes.get("Shared_Clean", 0) + sizes.get("Shared_Dirty", 0),
+        })
+    return rows
+
+def format_memory_report(rows):
+    lines = [f"{'pid':>8} {'role':<7} {'RSS MB':>9} {'PSS MB':>9} {'USS MB':>9} {'shared MB':>10}"]
+    for row in rows:
+        lines.append(f"{row['pid']:>8} {row['role']:<7} {row['rss'] / 2**20:>9.1f} {row['pss'] / 2**20:>9.1f} "
+                     f"{row['uss'] / 2**20:>9.1f} {row['shared'] / 2**20:>10.1f}")
+    lines.append(f"{'total':>8} {'':<7} {'':>9} {sum(row['pss'] for row in rows) / 2**20:>9.1f} "
+                 f"{sum(row['uss'] for row in rows) / 2**20:>9.1f}")
+    return "\n".join(lines)
+
+def run_worker(serve_worker, sock, workers):
+    import torch
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    # Split the cores between the workers instead of each one starting a thread per core
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    status = 0
+    try:
+        serve_worker(sock)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
+
+def fork_safe_models(models):
+    """
+    Returns the names of `models` that can be loaded before forking, leaving out the classifiers that would be
+    loaded as ONNX Runtime sessions.
+    """
+
+    from models import registry
+    from onnx_backend import classifier_tag
+    names = []
+    for name in registry.resolve(models):
+        if name in ONNX_CLASSIFIERS and classifier_tag(ONNX_CLASSIFIERS[name]) == "onnx":
+            print(f"- Not preloading {name}: ONNX Runtime sessions are created in each worker after the fork")
+        else:
+            names.append(name)
+    return names
+
+def serve(serve_worker, host, port, workers=PREFORK_WORKERS, models=PREFORK_MODELS):
+    """
+    Loads the models, forks `workers` processes serving on one shared socket and restarts any worker that exits.
+    The master never handles requests, but importing the server starts the worker threads of the batch engines, which
+    stay idle in the master; fork() only copies the calling thread, so each engine starts a new thread with an empty
+    queue in every worker (see `engine.BatchEngine`). The thread pools are created without threads, which they start
+    on first use, i.e. in the workers. After loading,
+    the garbage collector is frozen, so collections in the workers do not write to (and un-share) the pages
+    holding the master's objects. Returns when the master receives SIGINT or SIGTERM, after stopping the workers.
+    Args:
+        serve_worker (callable): Called in each worker with the listening socket; runs the server until the process ends.
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+        workers (int, optional): Number of workers. Defaults to `PREFORK_WORKERS`.
+        models (str or list, optional): Models loaded before forking. Defaults to `PREFORK_MODELS`.
+    """
+
+    from models import registry
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+    registry.warmup(fork_safe_models(models))
+    gc.collect()
+    gc.freeze()
+    sock = listen(host, port)
+    print(f"- Master {os.getpid()} listening on {host}:{port} with {workers} workers")
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(serve_worker, sock, workers)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def report(signum, frame):
+        print(format_memory_report(memory_report()), flush=True)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGUSR1, report)
+    for _ in range(workers):
+        spawn()
+    while children:
+        pid, status = os.wait()
+        children.discard(pid)
+        if not stopping:
+            print(f"- Worker {pid} exited with status {status}, restarting it")
+            spawn()
+    sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    memory_parser = commands.add_parser("memory", help="Print the memory report of a master and its workers")
+    memory_parser.add_argument("pid", type=int)
+    args = parser.parse_args()
+    rows = memory_report(args.pid)
+    if not rows:
+        sys.exit(f"No process with pid {args.pid}")
+    print(format_memory_report(rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Measures what the int8 / bf16 inference modes cost in accuracy and what they gain in latency and size.
+The RoBERTa hate-speech classifier and the ViT NSFW classifier are compared label by label against their fp32
+baseline on the fixture set, and DistilBART by the word overlap of its summary of the fixture article.
+Usage:
+    python quantization_check.py --mode int8
+    python quantization_check.py --mode bf16 --images ./media --no-summarizer
+"""
+import os
+import io
+import copy
+import json
+import glob
+import time
+import argparse
+
+# The modules below must load their full precision weights, which serve as the baseline
+os.environ["INFERENCE_MODE"] = "fp32"
+
+import torch
+import text_model
+import image_model
+from inference_mode import INFERENCE_MODES, optimize_model, model_dtype
+from models import registry
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def text_labels(model, sentences):
+    inputs = registry.get("hate_speech")["tokenizer"](sentences, padding=True, truncation=True, return_tensors="pt")
+    with torch.no_grad():
+        logits = model(**inputs.to(text_model.device)).logits
+    return [model.config.id2label[i] for i in logits.argmax(-1).tolist()]
+
+def image_labels(model, pixel_values):
+    batch = torch.stack(pixel_values).to(image_model.device, dtype=model_dtype(model))
+    with torch.no_grad():
+        logits = model(pixel_values=batch).logits
+    return [model.config.id2label[i] for i in logits.argmax(-1).tolist()]
+
+def compare_labels(name, baseline, candidate, inputs, labels_fn, describe):
+    expected, baseline_seconds = timed(labels_fn, baseline, inputs)
+    actual, candidate_seconds = timed(labels_fn, candidate, inputs)
+    flipped = [(describe(i), expected[i], actual[i]) for i in range(len(inputs)) if expected[i] != actual[i]]
+    report = {
+        "model": name,
+        "samples": len(inputs),
+        "agreement": 1 - len(flipped) / len(inputs),
+        "flipped": flipped,
+        "fp32_seconds": baseline_seconds,
+        "seconds": candidate_seconds,
+        "fp32_bytes": model_size(baseline),
+        "bytes": model_size(candidate),
+    }
+    print(f"{name}: {report['agreement']:.1%} of {len(inputs)} labels match fp32, "
+          f"{baseline_seconds * 1000:.0f} ms -> {candidate_seconds * 1000:.0f} ms, "
+          f"{report['fp32_bytes'] / 2**20:.0f} MB -> {report['bytes'] / 2**20:.0f} MB")
+    for sample, before, after in flipped:
+        print(f"  {before} -> {after}: {sample}")
+    return report
+
+def compare_summaries(mode):
+    import summarizer
+    with open(os.path.join(FIXTURES, "article.txt")) as f:
+        article = f.read()
+    baseline = registry.get("summarizer")["model"]
+    expected, baseline_seconds = timed(summarizer.summarize, article)
+    candidate = optimize_model(copy.deepcopy(baseline), summarizer.device, mode)
+    actual, candidate_seconds = timed(summarizer.summarize, article, candidate)
+    expected_words, actual_words = set(expected.lower().split()), set(actual.lower().split())
+    overlap = len(expected_words & actual_words) / max(1, len(expected_words | actual_words))
+    print(f"summarizer: {overlap:.1%} word overlap with the fp32 summary, "
+          f"{baseline_seconds:.2f} s -> {candidate_seconds:.2f} s")
+    return {
+        "model": "summarizer",
+        "word_overlap": overlap,
+        "fp32_seconds": baseline_seconds,
+        "seconds": candidate_seconds,
+        "fp32_bytes": model_size(baseline),
+        "bytes": model_size(candidate),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=[mode for mode in INFERENCE_MODES if mode != "fp32"], default="int8")
+    parser.add_argument("--sentences", default=os.path.join(FIXTURES, "sentences.jsonl"), help="JSONL file with a 'text' per line")
+    parser.add_argument("--images", default="./media", help="Directory of images to classify")
+    parser.add_argument("--no-summarizer", action="store_true", help="Skip the DistilBART comparison")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    with open(args.sentences) as f:
+        sentences = [json.loads(line)["text"] for line in f if line.strip()]
+    image_paths = sorted(path for path in glob.glob(os.path.join(args.images, "*")) if not path.endswith(".svg"))
+    pixel_values = []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            pixel_values.append(image_model.preprocess_image(f.read()))
+    image_paths = [path for path, values in zip(image_paths, pixel_values) if values is not None]
+    pixel_values = [values for values in pixel_values if values is not None]
+
+    text_baseline = registry.get("hate_speech")["model"]
+    reports = [compare_labels(
+        "text_model", text_baseline,
+        optimize_model(copy.deepcopy(text_baseline), text_model.device, args.mode),
+        sentences, text_labels, lambda i: sentences[i],
+    )]
+    if pixel_values:
+        image_baseline = registry.get("nsfw")["model"]
+        reports.append(compare_labels(
+            "image_model", image_baseline,
+            optimize_model(copy.deepcopy(image_baseline), image_model.device, args.mode),
+            pixel_values, image_labels, lambda i: image_paths[i],
+        ))
+    if not args.no_summarizer:
+        reports.append(compare_summaries(args.mode))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"mode": args.mode, "reports": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,120 @@
-import re
+import os
 import json
-import queue
-import threading
 # import subprocess
-from video_model import fake_video_news
-from image_model import detect_nsfw_image
-from text_model import detect_hate_speech
+from video_model import iter_videos_news
+from image_model import detect_nsfw_images
+from text_model import classify_hate_speech, hate_speech_replacer_batch, REWRITE_BATCH_SIZE
 from news_fakery import fake_news_detector
 from ytlink import get_youtube_links_from_url
 from audioSum import audio_summarize
+from engine import BatchEngine
+from llm_gateway import LLM_MAX_CONCURRENCY
+from concurrent.futures import Future, ThreadPoolExecutor
+from segmenter import sentence_spans, splice
+import metrics
+import tracing
+
+TEXT_MAX_BATCH_SIZE = int(os.getenv("TEXT_MAX_BATCH_SIZE", 32))
+TEXT_MAX_WAIT_MS = float(os.getenv("TEXT_MAX_WAIT_MS", 10))
+IMAGE_MAX_BATCH_SIZE = int(os.getenv("IMAGE_MAX_BATCH_SIZE", 32))
+IMAGE_MAX_WAIT_MS = float(os.getenv("IMAGE_MAX_WAIT_MS", 10))
+REWRITE_MAX_BATCH_SIZE = int(os.getenv("REWRITE_MAX_BATCH_SIZE", REWRITE_BATCH_SIZE))
+REWRITE_MAX_WAIT_MS = float(os.getenv("REWRITE_MAX_WAIT_MS", 50))
 
 class Agent:
     """
     Agent class for processing text and image data concurrently.
+    Each submission is tracked by its own Future, so concurrent API or Gradio requests never
+    share result storage. Items submitted by different requests are coalesced into micro-batches.
     Attributes:
-        text_queue (queue.Queue): Queue to hold text data for processing.
-        image_queue (queue.Queue): Queue to hold image URLs for processing.
-        processed_text (list): List to store processed text responses.
-        processed_image (Any): Variable to store the processed image result.
-        text_thread (threading.Thread): Thread for processing text data.
-        image_thread (threading.Thread): Thread for processing image data.
+        text_engine (BatchEngine): Micro-batching engine that classifies sentences as hate speech or not.
+        rewrite_engine (BatchEngine): Micro-batching engine that rewrites hate speech sentences with the LLM, so the
+            slow Gemini calls never hold up classification, and a failed rewrite only fails its own sentence.
+            Each document's sentences are rewritten in LLM requests of their own, never together with another's.
+        rewrite_pool (ThreadPoolExecutor): Runs the LLM requests of the documents in a rewrite batch concurrently.
+        image_engine (BatchEngine): Micro-batching engine that detects and replaces NSFW images by URL.
     Methods:
-        __init__(): Initializes the Agent with queues, processed data storage, and starts the processing threads.
-        process_text(): Continuously processes text data from the text_queue, detects hate speech, and stores the result.
-        process_image(): Continuously processes image URLs from the image_queue, detects NSFW content, and stores the result.
+        __init__(): Initializes the Agent with one engine per modality, using the configured batch size and wait time.
+        submit_sentence(sentence, document): Classifies a sentence of `document` and rewrites it if needed, returning
+            a Future of its text.
+        process_text(sentences): Runs batched hate speech classification on a batch of sentences.
+        rewrite_text(items): Rewrites a batch of `(document, sentence)` hate speech sentences, document by document.
+        process_image(urls): Runs NSFW detection on a batch of image URLs, fetching them concurrently.
     """
 
-    def __init__(self):
-        self.text_queue = queue.Queue()
-        self.image_queue = queue.Queue()
-        self.processed_text = []
-        self.processed_image = None
-
-        self.text_thread = threading.Thread(target=self.process_text, daemon=True)
-        self.image_thread = threading.Thread(target=self.process_image, daemon=True)
-        self.text_thread.start()
-        self.image_thread.start()
-
-    def process_text(self):
-        while True:
-            try:
-                sentence = self.text_queue.get(timeout=1)
-                respond_text = detect_hate_speech(sentence)
-                self.processed_text.append(respond_text)  
-                self.text_queue.task_done()
-            except queue.Empty:
-                continue
-
-    def process_image(self):
-        while True:
-            try:
-                img_url = self.image_queue.get(timeout=1)
-                self.processed_image = detect_nsfw_image(img_url)
-                self.image_queue.task_done()
-            except queue.Empty:
-                continue
+    def __init__(self, text_max_batch_size=TEXT_MAX_BATCH_SIZE, text_max_wait_ms=TEXT_MAX_WAIT_MS,
+                 image_max_batch_size=IMAGE_MAX_BATCH_SIZE, image_max_wait_ms=IMAGE_MAX_WAIT_MS):
+        self.text_engine = BatchEngine(self.process_text, text_max_batch_size, text_max_wait_ms, name="text-engine")
+        self.rewrite_engine = BatchEngine(self.rewrite_text, REWRITE_MAX_BATCH_SIZE, REWRITE_MAX_WAIT_MS, name="rewrite-engine")
+        self.image_engine = BatchEngine(self.process_image, image_max_batch_size, image_max_wait_ms, name="image-engine",
+                                        trace_items=True)
+        self.rewrite_pool = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="rewrite")
+
+    def submit_sentence(self, sentence, document):
+        result = Future()
+        # The rewrite is submitted from the text engine's thread, which is outside the caller's trace
+        context = tracing.current()
+
+        def rewritten(rewrite):
+            if rewrite.exception() is not None:
+                result.set_exception(rewrite.exception())
+            else:
+                result.set_result(rewrite.result())
 
+        def classified(verdict):
+            if verdict.exception() is not None:
+                result.set_exception(verdict.exception())
+            elif verdict.result() != "hate":
+                result.set_result(sentence)
+            else:
+                with tracing.attach(context):
+                    self.rewrite_engine.submit((document, sentence)).add_done_callback(rewritten)
+
+        self.text_engine.submit(sentence).add_done_callback(classified)
+        return result
+
+    def process_text(self, sentences):
+        return [label for label, _ in classify_hate_speech(sentences)]
+
+    def rewrite_text(self, items):
+        # Sentences of one document share an LLM prompt, so one user's text never shapes the rewrite of another's
+        documents = {}
+        for i, (document, _) in enumerate(items):
+            documents.setdefault(document, []).append(i)
+        groups = list(documents.values())
+        rewrites = self.rewrite_pool.map(
+            lambda group: hate_speech_replacer_batch([items[i][1] for i in group], return_exceptions=True), groups)
+        results = [None] * len(items)
+        for group, rewritten in zip(groups, rewrites):
+            for i, rewrite in zip(group, rewritten):
+                results[i] = rewrite
+        return results
+
+    def process_image(self, urls):
+        return detect_nsfw_images(urls)
+
+
+def submit_text_content(text):
+    """
+    Submits the sentences of `text` to the text engine, and the flagged ones on to the rewrite engine,
+    without waiting for them.
+    Returns:
+        tuple: The `(start, end)` span of each sentence in `text`, and a Future per sentence resolving to its
+               processed text. Pass both results to `segmenter.splice` to rebuild the text.
+    """
 
+    spans = sentence_spans(text)
+    document = object()
+    return spans, [agent.submit_sentence(text[start:end], document) for start, end in spans]
+
+@metrics.track_request("text")
 def process_text_content(text):
     """
     Processes the given text content by splitting it into sentences and queuing them for further processing.
-    This function detects hate speech by splitting the input text into sentences based on punctuation marks 
-    (., !, ?, ;, :). Each sentence is then added to a queue for further processing by an agent. The processed 
-    sentences are joined back into a single string and returned.
+    This function detects hate speech by locating the sentences of the input text with the segmenter.
+    Each sentence is then submitted to the agent's text engine, which batches it together with sentences 
+    from other requests. Only the sentences that were rewritten are spliced back into the text, so the rest 
+    of it, whitespace included, is returned unchanged.
     Args:
         text (str): The input text content to be processed.
     Returns:
@@ -72,49 +124,81 @@ def process_text_content(text):
     print("- Detecting hate speech...")
     # subprocess.run(["echo", "- Detecting hate speech..."])
     # print("BEFORE", text)
-    splits = re.split(r'([.!?;:])', text)
-    agent.processed_text.clear()
-    sentence_buffer = ""
-    for item in splits:
-        if item:
-            if item.strip() in ".!?;:":  
-                sentence_buffer += item  
-                agent.text_queue.put(sentence_buffer.strip())  
-                sentence_buffer = ""  
-            else:
-                sentence_buffer = item  
-    agent.text_queue.join()
-    result = ' '.join(agent.processed_text)
+    spans, futures = submit_text_content(text)
+    result = splice(text, spans, [future.result() for future in futures])
     # print("AFTER",result)
-    return result if result else text
+    return result
 
+def submit_image_content(urls):
+    """
+    Submits image URLs to the image engine without waiting for them.
+    All URLs are queued at once, so the images of a page are fetched and classified together.
+    Args:
+        urls (list): The URLs of the images to be processed. Each must be a valid HTTP or HTTPS URL.
+    Raises:
+        ValueError: If any URL is not a string or does not start with 'http://' or 'https://'.
+    Returns:
+        list: A Future per URL, in input order, resolving to the processed image.
+    """
+
+    for url in urls:
+        if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+            raise ValueError(f"Invalid URL: {url}")
+    return agent.image_engine.submit_many(urls)
+
+@metrics.track_request("image")
 def process_image_content(url):
     """
-    Processes an image URL by adding it to an image processing queue and waiting for the processing to complete.
+    Processes one image URL, or a list of them, by submitting them to the image engine and waiting for the results.
     Args:
-        url (str): The URL of the image to be processed. Must be a valid HTTP or HTTPS URL.
+        url (str or list): The URL of the image to be processed, or a list of URLs. Must be valid HTTP or HTTPS URLs.
     Raises:
-        ValueError: If the provided URL is not a string or does not start with 'http://' or 'https://'.
+        ValueError: If a provided URL is not a string or does not start with 'http://' or 'https://'.
     Returns:
-        processed_image: The processed image after it has been processed by the agent.
+        processed_image: The processed image after it has been processed by the agent, or a list of them in input order.
     """
 
     # print("BEFORE", url)
-    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
-        raise ValueError(f"Invalid URL: {url}")
-    agent.processed_image = None  
-    agent.image_queue.put(url)
-    agent.image_queue.join()  
-    # print("AFTER",agent.processed_image)
-    return agent.processed_image
-
-def process_url_content(url):
+    urls = url if isinstance(url, list) else [url]
+    processed_images = [future.result() for future in submit_image_content(urls)]
+    # print("AFTER",processed_images)
+    return processed_images if isinstance(url, list) else processed_images[0]
+
+def iter_url_content(url, page=None):
+    """
+    Runs the fake news detection of `process_url_content` and yields each verdict as soon as it is available.
+    Args:
+        url (str): The URL of the article to be processed.
+        page (PageContext, optional): The already fetched page, reused to find the YouTube links.
+    Yields:
+        dict: Events in this order:
+              {"type": "article", "result": <article_response_json>},
+              then, if the article is not fake, {"type": "videos", "urls": [<link1>, <link2>, ...]}
+              and one {"type": "video", "index": <i>, "url": <link>, "result": <video_response>} per video, in completion order.
+    """
+
+    article_response = fake_news_detector(url)
+    article_response_json = json.loads(article_response)
+    yield {"type": "article", "result": article_response_json}
+
+    if article_response_json['fake'] == False:
+        ytlink_list = get_youtube_links_from_url(url, page)
+        yield {"type": "videos", "urls": ytlink_list}
+        for i, response in iter_videos_news(ytlink_list):
+            yield {"type": "video", "index": i, "url": ytlink_list[i], "result": response}
+
+def video_key(index, link):
+    return f"Video {index+1} with URL {link}"
+
+@metrics.track_request("url")
+def process_url_content(url, page=None):
     """
     Processes the content of a given URL to detect fake news in both articles and associated YouTube videos.
     This function first checks the article content at the given URL for fake news using the `fake_news_detector` function.
-    If the article is not fake, it then retrieves YouTube links from the URL and checks each video for fake news using the `fake_video_news` function.
+    If the article is not fake, it then retrieves YouTube links from the URL and checks the videos for fake news in parallel using the `iter_videos_news` function.
     Args:
         url (str): The URL of the article to be processed.
+        page (PageContext, optional): The already fetched page, reused to find the YouTube links.
     Returns:
         dict: A dictionary containing the results of the fake news detection for the article and any associated YouTube videos.
               The dictionary has the following structure:
@@ -129,24 +213,25 @@ def process_url_content(url):
               If the article is fake, the "Video" key will not be present in the dictionary.
     """
 
-    article_response = fake_news_detector(url)
-    article_response_json = json.loads(article_response)
-    combined_response = {"Article": article_response_json}
-
-    if article_response_json['fake'] == False:
-        ytlink_list = get_youtube_links_from_url(url)
-        video_response = {}
-        for i, link in enumerate(ytlink_list):
-            response = fake_video_news(link)
-            video_response[f"Video {i+1} with URL {link}"] = response
-
-        combined_response["Video"] = video_response
-
+    combined_response = {}
+    video_responses = {}
+    for event in iter_url_content(url, page):
+        if event["type"] == "article":
+            combined_response["Article"] = event["result"]
+        elif event["type"] == "videos":
+            combined_response["Video"] = {}
+        else:
+            video_responses[event["index"]] = video_key(event["index"], event["url"]), event["result"]
+    if "Video" in combined_response:
+        combined_response["Video"] = dict(video_responses[i] for i in sorted(video_responses))
     return combined_response
 
-def process_audio_content(url):
+@metrics.track_request("audio")
+def process_audio_content(url, page=None):
     
-    result = audio_summarize(url)
+    result = audio_summarize(url, page)
     return result
 
-agent = Agent()
\ No newline at end of file
+agent = Agent()
+metrics.Gauge("engine_queue_depth", "Items waiting in a batch engine's queue", ["engine"],
+              fn=lambda: [({"engine": engine.name}, engine.queue.qsize()) for engine in (agent.text_engine, agent.rewrite_engine, agent.image_engine)])
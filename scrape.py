@@ -1,22 +1,28 @@
 import requests
+import metrics
 # import subprocess
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin
+from page_context import get_page
 from custom_css import DARK_THEME_CSS
 
-def scrape_content(url):
+@metrics.stage("scrape")
+def scrape_content(url, page=None):
     """
     Scrapes content from a given URL and processes it.
     This function fetches the HTML content from the specified URL, parses it using BeautifulSoup,
     and extracts text elements, image elements, and styles. It also converts relative image URLs
     to absolute URLs and appends a custom dark theme CSS to the HTML head.
+    The page is taken from the given PageContext, or from `get_page` otherwise, and its document is modified in place.
     Args:
         url (str): The URL of the webpage to scrape.
+        page (PageContext, optional): The already fetched page to use.
     Returns:
         tuple: A tuple containing:
             - content (dict): A dictionary with the following keys:
                 - 'text' (list): A list of text content from <p>, <h1>, <h2>, <h3>, <span>, <a>, and <li> elements.
                 - 'images' (list): A list of absolute URLs of images.
+                - 'text_elements' (list): The elements the 'text' entries were taken from, in the same order.
+                - 'image_elements' (list): The <img> elements the 'images' entries were taken from, in the same order.
                 - 'styles' (ResultSet): A BeautifulSoup ResultSet of <style> elements.
                 - 'css_links' (ResultSet): A BeautifulSoup ResultSet of <link> elements with rel="stylesheet".
             - soup (BeautifulSoup): The BeautifulSoup object of the parsed HTML content.
@@ -25,9 +31,8 @@ def scrape_content(url):
     """
     print("- Scraping content from URL...")
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser', from_encoding='utf-8')
+        page = page or get_page(url)
+        soup = page.soup
         styles = soup.find_all('style')
         css_links = soup.find_all('link', rel="stylesheet")
         custom_style_tag = soup.new_tag('style')
@@ -41,9 +46,12 @@ def scrape_content(url):
             if img_src and not img_src.startswith(('http://', 'https://')):
                 img['src'] = urljoin(url, img_src)  
         # Prepare content for processing
+        image_elements = [img for img in image_elements if img.get('src')]
         content = {
             'text': [el.get_text() for el in text_elements],
-            'images': [img['src'] for img in image_elements if img.get('src')],
+            'images': [img['src'] for img in image_elements],
+            'text_elements': text_elements,
+            'image_elements': image_elements,
             'styles': styles,
             'css_links': css_links
         }
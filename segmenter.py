@@ -0,0 +1,52 @@
+"""
+Sentence segmentation by offsets: sentences are located as `(start, end)` spans of the original string instead of
+being rebuilt from pieces, and the moderated text is put back together by splicing only the rewritten sentences
+into it. Unchanged text, including its whitespace and any trailing words without end punctuation, is kept exactly.
+"""
+import re
+
+SENTENCE_END = ".!?;:"
+# A sentence starts at a non-space character and runs up to a run of end punctuation marks, or, for the trailing
+# text of a document, up to its last non-space character
+SENTENCE = re.compile(rf"\S(?:[^{SENTENCE_END}]*[{SENTENCE_END}]+|[^{SENTENCE_END}]*\S)?")
+
+
+def iter_sentence_spans(text):
+    """
+    Yields the sentences of `text` as offsets, lazily, so a large document is never copied as a whole.
+    Args:
+        text (str): The input text content.
+    Yields:
+        tuple: `(start, end)` of each sentence, with `text[start:end]` free of surrounding whitespace and ending
+               with its punctuation marks, if it has any.
+    """
+
+    for match in SENTENCE.finditer(text):
+        yield match.span()
+
+def sentence_spans(text):
+    return list(iter_sentence_spans(text))
+
+def splice(text, spans, replacements):
+    """
+    Rebuilds `text` with the sentence at each span replaced by its replacement.
+    Only the spans whose replacement differs are copied in; everything else is taken from `text` as is.
+    Args:
+        text (str): The original text.
+        spans (list): The `(start, end)` spans, in order, as returned by `iter_sentence_spans`.
+        replacements (list): The new text of each span, in the same order.
+    Returns:
+        str: The rebuilt text, or `text` itself if nothing changed.
+    """
+
+    parts = []
+    position = 0
+    for (start, end), replacement in zip(spans, replacements):
+        if replacement != text[start:end]:
+            parts.append(text[position:start])
+            parts.append(replacement)
+            position = end
+    if not parts:
+        return text
+    parts.append(text[position:])
+    return "".join(parts)
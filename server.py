@@ -1,32 +1,182 @@
-from flask_cors import CORS
-from flask import Flask, request, jsonify
-from queuing import process_image_content, process_text_content, process_url_content
-
-app = Flask(__name__)
-CORS(app)
-
-
-@app.route('/process/text', methods=['POST'])
-def process_text():
-    content = request.get_json()
-    sentences = content['text']
-    response = process_text_content(sentences)
-    return jsonify(response), 200
-
-@app.route('/process/image', methods=['POST'])
-def process_image():
-    content = request.get_json()
-    images = content['images']  
-    response = process_image_content(images)
-    return jsonify(response), 200
-
-@app.route('/process/url', methods=['POST'])
-def process_url():
-    content = request.get_json()
-    url = content['url']
-    response = process_url_content(url)
-    return jsonify(response), 200
+import os
+import json
+import asyncio
+import uvicorn
+import contextvars
+import metrics
+import tracing
+from typing import List, Union
+from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.middleware.cors import CORSMiddleware
+from admission import AdmissionMiddleware, RETRY_AFTER
+from models import registry, WARMUP_MODELS
+from prefork import PREFORK_WORKERS, serve
+from jobs import JobManager, JobQueueFull
+from segmenter import splice
+from queuing import submit_text_content, submit_image_content, process_url_content, iter_url_content
+
+HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+PORT = int(os.getenv("SERVER_PORT", 5000))
+# Threads running the blocking URL pipeline (article verdict and videos); text and images go through the batch engines
+URL_WORKERS = int(os.getenv("SERVER_URL_WORKERS", 4))
+
+
+
+class TraceMiddleware:
+    """
+    Starts the trace of every request before the endpoint runs, so its spans are recorded under the id returned in
+    the X-Trace-Id response header. A client can pass its own id in an X-Trace-Id request header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace_id = tracing.start_trace(dict(scope["headers"]).get(b"x-trace-id", b"").decode("latin-1"))
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-trace-id", trace_id.encode())]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_trace_id)
+
+
+app = FastAPI()
+# The middleware added last runs first: CORS wraps the admission control, so its 413 / 429 rejections carry the
+# CORS headers and browsers can read them, and preflight requests are answered without taking a slot
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Trace-Id", "Retry-After"])
+app.add_middleware(TraceMiddleware)
+url_pool = ThreadPoolExecutor(max_workers=URL_WORKERS, thread_name_prefix="url-worker")
+job_manager = JobManager(iter_url_content)
+# Jobs live in the memory of the worker that runs them, and the prefork workers share one socket, so polls and
+# streams could reach another worker; the job API is only served by a single process
+JOBS_ENABLED = PREFORK_WORKERS <= 1
+# Seconds between keep-alive comments on idle event streams, so proxies do not close them
+KEEPALIVE_INTERVAL = 15
+# Token expected in the X-Admin-Token header of the admin endpoints, which are disabled without it
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+class TextRequest(BaseModel):
+    text: str
+
+class ImageRequest(BaseModel):
+    images: Union[str, List[str]]
+
+class UrlRequest(BaseModel):
+    url: str
+
+class ProfileRequest(BaseModel):
+    kind: str = None
 
-if __name__ == '__main__':
-    app.run(debug=True)
 
+@app.post('/process/text')
+async def process_text(content: TextRequest):
+    # Sentences are awaited on the text engine's futures, so no thread is held while they are classified
+    with metrics.track_request("text"):
+        spans, futures = submit_text_content(content.text)
+        results = await asyncio.gather(*map(asyncio.wrap_future, futures))
+    return splice(content.text, spans, results)
+
+@app.post('/process/image')
+async def process_image(content: ImageRequest):
+    urls = content.images if isinstance(content.images, list) else [content.images]
+    with metrics.track_request("image"):
+        try:
+            futures = submit_image_content(urls)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        processed_images = await asyncio.gather(*map(asyncio.wrap_future, futures))
+    return processed_images if isinstance(content.images, list) else processed_images[0]
+
+@app.post('/process/url')
+async def process_url(content: UrlRequest):
+    # run_in_executor does not carry the context over, so the worker thread would start a trace of its own
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(url_pool, context.run, process_url_content, content.url)
+
+@app.post('/jobs', status_code=202)
+async def submit_job(content: UrlRequest):
+    # Jobs for a URL already being analyzed share that run
+    require_jobs()
+    try:
+        job, deduplicated = job_manager.submit(content.url)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(RETRY_AFTER)})
+    return {"job_id": job.id, "status": job.status, "trace_id": job.trace_id, "deduplicated": deduplicated}
+
+def require_jobs():
+    if not JOBS_ENABLED:
+        raise HTTPException(status_code=503, detail="The job API is not available with PREFORK_WORKERS > 1, use /process/url")
+
+def get_job(job_id):
+    require_jobs()
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+@app.get('/jobs/{job_id}')
+async def poll_job(job_id: str):
+    return get_job(job_id).to_dict()
+
+@app.get('/jobs/{job_id}/events')
+async def stream_job(job_id: str, request: Request, format: str = None):
+    """
+    Streams the events of a job from the start as Server-Sent Events, or as NDJSON with `?format=ndjson`
+    (or an `Accept: application/x-ndjson` header). The stream ends after the "done" or "error" event.
+    """
+
+    job = get_job(job_id)
+    ndjson = format == "ndjson" or (format is None and "application/x-ndjson" in request.headers.get("accept", ""))
+
+    async def events():
+        cursor = 0
+        while True:
+            await job.wait(cursor, KEEPALIVE_INTERVAL)
+            if cursor == len(job.events) and not ndjson:
+                yield ": keep-alive\n\n"
+            for event in job.events[cursor:]:
+                cursor += 1
+                data = json.dumps(event)
+                yield data + "\n" if ndjson else f"event: {event['type']}\ndata: {data}\n\n"
+                if event["type"] in ("done", "error"):
+                    return
+
+    media_type = "application/x-ndjson" if ndjson else "text/event-stream"
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format; with PREFORK_WORKERS each scrape is answered by one of the workers
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post('/admin/profile')
+async def profile_next_request(content: ProfileRequest, x_admin_token: str = Header(None)):
+    """
+    Attaches the sampling profiler to the next request of this worker, or the next one of `kind`.
+    The folded stacks are written to PROFILE_DIR/<trace id>.folded, ready for flamegraph.pl or speedscope.
+    """
+
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints need a valid X-Admin-Token")
+    tracing.arm_profiler(content.kind)
+    return {"armed": True, "kind": content.kind, "profile_dir": tracing.PROFILE_DIR}
+
+def serve_worker(sock):
+    uvicorn.Server(uvicorn.Config(app, log_level="info")).run(sockets=[sock])
+
+if __name__ == '__main__':
+    if PREFORK_WORKERS:
+        # Models are loaded once here and shared copy-on-write by the forked workers
+        serve(serve_worker, HOST, PORT)
+    else:
+        registry.warmup(WARMUP_MODELS)
+        uvicorn.run(app, host=HOST, port=PORT)
@@ -1,18 +1,26 @@
 import time
 import torch
 from transformers import AutoTokenizer, BartForConditionalGeneration
+from inference_mode import optimize_model
+from models import registry
+import metrics
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 fb = "sshleifer/distilbart-cnn-12-6"
-model = BartForConditionalGeneration.from_pretrained(fb)
-tokenizer = AutoTokenizer.from_pretrained(fb)
-model.to(device)
 
-def summarize(allPara):
+def load_summarizer_model():
+    model = BartForConditionalGeneration.from_pretrained(fb)
+    return {"tokenizer": AutoTokenizer.from_pretrained(fb), "model": optimize_model(model.to(device), device)}
+
+registry.register("summarizer", load_summarizer_model)
+
+@metrics.stage("summarize")
+def summarize(allPara, model=None):
     """
     Summarizes the given text using a pre-trained model.
     Args:
         allPara (str): The input text to be summarized.
+        model (torch.nn.Module, optional): The model to use instead of the registry's "summarizer" model.
     Returns:
         str: The summarized text.
     Description:
@@ -22,6 +30,9 @@ def summarize(allPara):
     """
 
     start = time.time()
+    summarizer = registry.get("summarizer")
+    tokenizer = summarizer["tokenizer"]
+    model = model if model is not None else summarizer["model"]
     inputs = tokenizer(allPara,max_length=1024, truncation=True, padding="longest", return_tensors="pt")
     input_length = inputs['input_ids'].shape[1]
     max_summary_length = min(int(input_length * 0.3), 400)
@@ -3,19 +3,45 @@ import json
 import torch
 # import subprocess
 from dotenv import load_dotenv
-import google.generativeai as genai
+from llm_gateway import gateway
 from google.ai.generativelanguage_v1beta.types import content
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+from cache import TwoTierCache, make_key
+from inference_mode import optimize_model
+from onnx_backend import load_classifier, classifier_tag
+from models import registry
+from prefilter import prefilter
+import metrics
 
 load_dotenv()
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 # location = "../finetuned_text_model"
 location = "facebook/roberta-hate-speech-dynabench-r4-target"
-HFtokenizer = AutoTokenizer.from_pretrained(location)
-HFmodel = AutoModelForSequenceClassification.from_pretrained(location)
-HFmodel.to(device)
+# Verdict cache model id: the checkpoint and the backend / inference mode it runs with
+VERDICT_MODEL_ID = f"{location}:{classifier_tag('text')}"
+
+def load_hate_speech_model():
+  """
+  Loads the hate speech classifier; registered as "hate_speech" and called once by the model registry.
+  Returns:
+    dict: The `tokenizer`, the `id2label` mapping, and either the ONNX `onnx_classifier` (when CLASSIFIER_BACKEND=onnx
+    and the graph has been exported) or the PyTorch `model`; the other one is None.
+  """
+
+  onnx_classifier = load_classifier("text")
+  model = None
+  if onnx_classifier is None:
+      model = AutoModelForSequenceClassification.from_pretrained(location)
+      model = optimize_model(model.to(device), device)
+  return {
+      "tokenizer": AutoTokenizer.from_pretrained(location),
+      "model": model,
+      "onnx_classifier": onnx_classifier,
+      "id2label": AutoConfig.from_pretrained(location).id2label,
+  }
+
+registry.register("hate_speech", load_hate_speech_model)
 # Config for gemini model
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
 generation_config = {
   "temperature": 0,
   "top_p": 0.95,
@@ -33,12 +59,129 @@ generation_config = {
   ),
   "response_mime_type": "application/json",
 }
-model = genai.GenerativeModel(
-  model_name="gemini-1.5-flash",
+GEMINI_MODEL = "gemini-1.5-flash"
+gateway.register(
+  "hate_speech_rewrite",
+  model_name=GEMINI_MODEL,
   generation_config=generation_config,
   system_instruction="user will provide a inappropriate/hate-speech sentence and you need to convert it into the positive version, which is just one sentence long. Make sure the same pronoun is preserved.",
 )
-chat_session = model.start_chat()
+# Config for gemini model rewriting several sentences in one request
+batch_generation_config = {
+  "temperature": 0,
+  "top_p": 0.95,
+  "top_k": 64,
+  "max_output_tokens": 8192,
+  "response_schema": content.Schema(
+    type = content.Type.OBJECT,
+    enum = [],
+    required = ["rewrites"],
+    properties = {
+      "rewrites": content.Schema(
+        type = content.Type.ARRAY,
+        items = content.Schema(
+          type = content.Type.OBJECT,
+          enum = [],
+          required = ["index", "positive"],
+          properties = {
+            "index": content.Schema(
+              type = content.Type.INTEGER,
+            ),
+            "positive": content.Schema(
+              type = content.Type.STRING,
+            ),
+          },
+        ),
+      ),
+    },
+  ),
+  "response_mime_type": "application/json",
+}
+gateway.register(
+  "hate_speech_rewrite_batch",
+  model_name=GEMINI_MODEL,
+  generation_config=batch_generation_config,
+  system_instruction="user will provide a JSON list of inappropriate/hate-speech sentences, each with an index. Convert every sentence into the positive version, which is just one sentence long, and return it with the same index. Make sure the same pronoun is preserved.",
+)
+
+BATCH_SIZE = int(os.getenv("TEXT_BATCH_SIZE", 32))
+# Rewrites are cached for a week by default, so prompt or model drift eventually shows up in the output
+REWRITE_TTL = float(os.getenv("REWRITE_CACHE_TTL", 7 * 24 * 3600))
+REWRITE_BATCH_SIZE = int(os.getenv("REWRITE_BATCH_SIZE", 20))
+verdict_cache = TwoTierCache("sentence_verdicts")
+rewrite_cache = TwoTierCache("sentence_rewrites", ttl=REWRITE_TTL)
+
+def classify_hate_speech(texts, batch_size=BATCH_SIZE, use_prefilter=True):
+  """
+  Classifies a list of sentences with the pre-trained Hugging Face model.
+  When the pre-filter is enabled, sentences it clears are labelled "nothate" with the score 1 - P(hate) it
+  estimated and skip the model (see `prefilter`). The others are tokenized once, sorted by token length and grouped into padded batches, so each 
+  forward pass only pads up to the longest sentence of similar length. Results are scattered back 
+  to the original positions. Verdicts are cached per sentence, so only unseen sentences reach the model.
+  Args:
+    texts (list): The sentences to be classified.
+    batch_size (int, optional): The maximum number of sentences per forward pass. Defaults to `BATCH_SIZE`.
+    use_prefilter (bool, optional): Set to False to classify every sentence with the model.
+  Returns:
+    list: A `(label, score)` tuple for each sentence, in input order. Empty sentences get `("nothate", 1.0)`.
+  """
+
+  results = [("nothate", 1.0)] * len(texts)
+  cleared = {}
+  if use_prefilter and prefilter is not None:
+      with metrics.stage("prefilter"):
+          probabilities = {i: prefilter.hate_probability(text) for i, text in enumerate(texts) if text}
+          cleared = {i: probability for i, probability in probabilities.items() if prefilter.clears(probability)}
+  indices = []
+  for i, text in enumerate(texts):
+      if not text:
+          continue
+      if i in cleared:
+          results[i] = ("nothate", 1 - cleared[i])
+          continue
+      cached = verdict_cache.get(make_key(text, VERDICT_MODEL_ID))
+      if cached is not None:
+          results[i] = tuple(cached)
+      else:
+          indices.append(i)
+  if not indices:
+      return results
+  classifier = registry.get("hate_speech")
+  tokenizer = classifier["tokenizer"]
+  with metrics.stage("tokenize"):
+      encodings = tokenizer([texts[i] for i in indices], truncation=True)["input_ids"]
+  order = sorted(range(len(indices)), key=lambda j: len(encodings[j]))
+  for start in range(0, len(order), batch_size):
+      bucket = order[start:start + batch_size]
+      inputs = tokenizer.pad({"input_ids": [encodings[j] for j in bucket]}, return_tensors="pt")
+      with metrics.stage("inference_text"):
+          if classifier["onnx_classifier"] is not None:
+              probs = classifier["onnx_classifier"].logits(**inputs).float().softmax(-1)
+          else:
+              with torch.no_grad():
+                  probs = classifier["model"](**inputs.to(device)).logits.float().softmax(-1)
+      scores, class_ids = probs.max(-1)
+      for j, class_id, score in zip(bucket, class_ids.tolist(), scores.tolist()):
+          results[indices[j]] = (classifier["id2label"][class_id], score)
+          verdict_cache.set(make_key(texts[indices[j]], VERDICT_MODEL_ID), results[indices[j]])
+  return results
+
+def detect_hate_speech_batch(texts):
+  """
+  Detects and replaces hate speech in a list of sentences.
+  All sentences are classified together with `classify_hate_speech`; the ones labelled as hate speech 
+  are then replaced together with a sanitized version using the `hate_speech_replacer_batch` function.
+  Args:
+    texts (list): The sentences to be analyzed for hate speech.
+  Returns:
+    list: For each sentence, the sanitized text if hate speech is detected, otherwise the original text.
+  """
+
+  results = list(texts)
+  flagged = [i for i, (label, _) in enumerate(classify_hate_speech(texts)) if label == "hate"]
+  for i, replaced_text in zip(flagged, hate_speech_replacer_batch([texts[i] for i in flagged])):
+      results[i] = replaced_text
+  return results
 
 def detect_hate_speech(text):
   """
@@ -54,31 +197,84 @@ def detect_hate_speech(text):
   
   if not text:
       return text
-  inputs = HFtokenizer(text, return_tensors="pt")
-  with torch.no_grad():
-      logits = HFmodel(**inputs.to(device)).logits
-  predicted_class_id = logits.argmax().item()
-  predicted_label = HFmodel.config.id2label[predicted_class_id]
-  if predicted_label == "nothate":
-      return text
-  elif predicted_label == "hate":
-      replaced_text = hate_speech_replacer(text)
-      return replaced_text
+  return detect_hate_speech_batch([text])[0]
 
 def hate_speech_replacer(text):
   """
   Replaces hate speech in the given text with positive language.
-  This function sends the input text to a chat session for processing. 
-  The chat session returns a response which is then parsed to extract 
-  the positive language replacement for any detected hate speech.
+  This function sends the input text to the LLM gateway as a stateless request. 
+  The gateway returns a response which is then parsed to extract 
+  the positive language replacement for any detected hate speech. Rewrites are cached, so a 
+  sentence seen before within `REWRITE_TTL` seconds does not cost another Gemini round trip.
   Args:
     text (str): The input text that may contain hate speech.
   Returns:
     str: The text with hate speech replaced by positive alternative language.
   """
 
+  key = make_key(text, GEMINI_MODEL)
+  cached = rewrite_cache.get(key)
+  if cached is not None:
+      return cached
   print("- Replacing hate speech...") 
   # subprocess.run(["echo", "- Replacing hate speech..."])
-  response = chat_session.send_message(text)
-  response_json = json.loads(response.text)
-  return response_json['positive']
\ No newline at end of file
+  response_json = gateway.generate_json("hate_speech_rewrite", text)
+  rewrite_cache.set(key, response_json['positive'])
+  return response_json['positive']
+
+@metrics.stage("rewrite")
+def hate_speech_replacer_batch(texts, return_exceptions=False):
+  """
+  Replaces hate speech in several sentences with positive language, using one LLM request per 
+  `REWRITE_BATCH_SIZE` sentences instead of one per sentence.
+  Cached rewrites are reused. The remaining sentences are sent together as an indexed JSON list, and the 
+  response schema returns an array of rewrites keyed by index. Only sentences whose rewrite is missing or 
+  invalid (or all of them, if the request itself fails) fall back to `hate_speech_replacer`.
+  Args:
+    texts (list): The sentences that contain hate speech.
+    return_exceptions (bool, optional): Return the exception of a sentence whose fallback request failed in its
+      place instead of raising it, so one failed sentence does not fail the others.
+  Returns:
+    list: The rewritten sentences, in input order.
+  """
+
+  results = [None] * len(texts)
+  pending = {}
+  for i, text in enumerate(texts):
+      cached = rewrite_cache.get(make_key(text, GEMINI_MODEL))
+      if cached is not None:
+          results[i] = cached
+      else:
+          pending.setdefault(text, []).append(i)
+  unique = list(pending)
+  for start in range(0, len(unique), REWRITE_BATCH_SIZE):
+      chunk = unique[start:start + REWRITE_BATCH_SIZE]
+      rewrites = {}
+      if len(chunk) > 1:
+          print(f"- Replacing hate speech in {len(chunk)} sentences...")
+          prompt = json.dumps([{"index": j, "sentence": text} for j, text in enumerate(chunk)])
+          try:
+              response_json = gateway.generate_json("hate_speech_rewrite_batch", prompt)
+              for entry in response_json.get("rewrites", []):
+                  if not isinstance(entry, dict):
+                      continue
+                  index, positive = entry.get("index"), entry.get("positive")
+                  if isinstance(index, int) and 0 <= index < len(chunk) and isinstance(positive, str) and positive.strip():
+                      rewrites.setdefault(index, positive)
+          except Exception as e:
+              print(f"- Batched rewrite failed ({e}), falling back to one request per sentence...")
+      for j, text in enumerate(chunk):
+          if j in rewrites:
+              rewrite_cache.set(make_key(text, GEMINI_MODEL), rewrites[j])
+              replaced_text = rewrites[j]
+          else:
+              try:
+                  replaced_text = hate_speech_replacer(text)
+              except Exception as e:
+                  if not return_exceptions:
+                      raise
+                  print(f"- Rewrite failed ({e})")
+                  replaced_text = e
+          for i in pending[text]:
+              results[i] = replaced_text
+  return results
\ No newline at end of file
@@ -0,0 +1,263 @@
+"""
+Per-request tracing: every moderation request gets a trace id, and each stage it goes through is recorded as a span
+in a rotating JSONL log (one span per line, with its trace id, parent span, timing, status and attributes).
+The current trace is held in a context variable, so it follows the request through function calls and asyncio
+tasks; the batch engines and the video worker processes carry it over explicitly.
+A sampling profiler can be armed to profile the next request; it writes the stacks in the folded format read by
+flamegraph.pl and speedscope.
+"""
+import os
+import sys
+import json
+import time
+import re
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from dotenv import load_dotenv
+
+load_dotenv()
+# Set TRACE_LOG="" to disable the trace log; trace ids are still assigned
+TRACE_LOG = os.getenv("TRACE_LOG", os.path.join("logs", "traces.jsonl"))
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("logs", "profiles"))
+# Seconds between two samples of the profiler
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+
+# (trace_id, span_id) of the current span; span_id is None before the first span of a trace
+_current = contextvars.ContextVar("trace", default=None)
+_capture = threading.local()
+_logger = None
+_logger_pid = None
+_logger_lock = threading.Lock()
+# Forked processes, such as the prefork workers, write to a file of their own: rotating one file from several
+# processes loses and interleaves lines
+_main_pid = os.getpid()
+_armed = None
+_armed_lock = threading.Lock()
+
+
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+def current():
+    """
+    Returns the current `(trace_id, span_id)`, or None outside of a trace. Pass it to `attach` to continue the trace
+    in another thread or process.
+    """
+
+    return _current.get()
+
+def current_trace_id():
+    context = _current.get()
+    return context[0] if context else None
+
+@contextmanager
+def attach(context):
+    """
+    Makes `context`, as returned by `current`, the current trace for the duration of the block.
+    """
+
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+def start_trace(trace_id=None):
+    """
+    Assigns a trace id to the current context without opening a span, e.g. in a server middleware, so the id can
+    be returned to the client while the request's spans are recorded under it. A `trace_id` that is not 1 to 32
+    hexadecimal digits is replaced by a new one. Returns the trace id.
+    """
+
+    if not trace_id or not re.fullmatch(r"[0-9a-f]{1,32}", trace_id):
+        trace_id = new_id()
+    _current.set((trace_id, None))
+    return trace_id
+
+def trace_log_path():
+    """
+    Returns TRACE_LOG in the process that imported this module first, and TRACE_LOG with the pid inserted before
+    its extension (e.g. logs/traces.1234.jsonl) in processes forked from it.
+    """
+
+    if os.getpid() == _main_pid:
+        return TRACE_LOG
+    root, extension = os.path.splitext(TRACE_LOG)
+    return f"{root}.{os.getpid()}{extension}"
+
+def _after_fork():
+    global _logger_lock
+    # Another thread may have held the lock at the time of the fork
+    _logger_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def get_logger():
+    global _logger, _logger_pid
+    with _logger_lock:
+        if _logger_pid != os.getpid():
+            _logger = logging.getLogger("moderation.traces")
+            _logger.propagate = False
+            _logger.setLevel(logging.INFO)
+            # A handler inherited through fork() still writes to the parent's file
+            for handler in list(_logger.handlers):
+                _logger.removeHandler(handler)
+            path = trace_log_path()
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(path, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _logger.addHandler(handler)
+            _logger_pid = os.getpid()
+        return _logger
+
+def write(record):
+    spans = getattr(_capture, "spans", None)
+    if spans is not None:
+        spans.append(record)
+    elif TRACE_LOG:
+        get_logger().info(json.dumps(record, default=str))
+
+def record_span(name, context, start, duration, span_id=None, error=None, **attributes):
+    """
+    Writes a finished span. Used directly for work that is not a block of code, such as a batch of the engines.
+    Args:
+        name (str): The span name.
+        context (tuple): The `(trace_id, parent_span_id)` the span belongs to.
+        start (float): Start time, as `time.time()`.
+        duration (float): Duration in seconds.
+        span_id (str, optional): The span id. Defaults to a new one.
+        error (str, optional): The error message if the work failed.
+        **attributes: Extra JSON-serializable attributes.
+    """
+
+    write({
+        "trace_id": context[0],
+        "span_id": span_id or new_id(),
+        "parent_id": context[1],
+        "name": name,
+        "start": start,
+        "duration_ms": duration * 1000,
+        "status": "error" if error is not None else "ok",
+        "error": error,
+        "attributes": attributes,
+        "pid": os.getpid(),
+        "thread": threading.current_thread().name,
+    })
+
+@contextmanager
+def span(name, root=False, **attributes):
+    """
+    Records the block as a span of the current trace. Outside of a trace nothing is recorded, unless `root` is set,
+    in which case a new trace is started. Yields the attributes dict, which the block can add to.
+    """
+
+    context = _current.get()
+    if context is None and not root:
+        yield attributes
+        return
+    trace_id, parent_id = context if context is not None else (new_id(), None)
+    span_id = new_id()
+    token = _current.set((trace_id, span_id))
+    profiler = take_profiler(name) if parent_id is None else None
+    start, begin = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if profiler is not None:
+            attributes["profile"] = profiler.stop(os.path.join(PROFILE_DIR, f"{trace_id}.folded"))
+        _current.reset(token)
+        record_span(name, (trace_id, parent_id), start, time.perf_counter() - begin, span_id, error, **attributes)
+
+@contextmanager
+def capture():
+    """
+    Collects the spans written by the current thread instead of logging them, so a worker process can send them
+    back to the parent, which writes them with `replay`. Yields the list of span records.
+    """
+
+    spans = []
+    _capture.spans = spans
+    try:
+        yield spans
+    finally:
+        _capture.spans = None
+
+def replay(spans):
+    for record in spans:
+        write(record)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread of the process from a background thread every `interval` seconds.
+    The request's work runs in several threads (server, batch engines, fetcher), so all of them are sampled;
+    each stack starts with the thread name.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, path):
+        """
+        Stops sampling and writes the folded stacks to `path`. Returns the path.
+        """
+
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"- Wrote profile of {sum(self.stacks.values())} samples to {path}")
+        return path
+
+
+def arm_profiler(kind=None):
+    """
+    Profiles the next request, or the next request of the given kind ("text", "image", "url", "audio" or "job").
+    The profile is written to `PROFILE_DIR/<trace id>.folded` and its path added to the request's root span.
+    """
+
+    global _armed
+    with _armed_lock:
+        _armed = {"kind": kind}
+
+def take_profiler(name):
+    global _armed
+    with _armed_lock:
+        if _armed is None or _armed["kind"] not in (None, name):
+            return None
+        _armed = None
+    return SamplingProfiler()
@@ -2,10 +2,19 @@ import os
 import json
 import time
 import torch
-import whisper
+import numpy as np
+import tempfile
 import subprocess
-from summarizer import summarize
-from news_fakery import fake_video_detector
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import TwoTierCache
+from summarizer import summarize, fb
+from ytlink import normalize_video_id
+from news_fakery import fake_video_detector, GEMINI_MODEL
+from inference_mode import INFERENCE_MODE, optimize_model
+from models import registry
+import metrics
+import tracing
 # from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
 # S2T_MODEL_ID = "jonatasgrosman/wav2vec2-large-xlsr-53-english"
@@ -14,41 +23,109 @@ from news_fakery import fake_video_detector
 device = "cuda" if torch.cuda.is_available() else "cpu"
 # Stokenizer = AutoTokenizer.from_pretrained(SUM_MODEL_ID)
 # Smodel = AutoModelForSeq2SeqLM.from_pretrained(SUM_MODEL_ID)
-model = whisper.load_model("base").to(device)
+WHISPER_MODEL = "base"
+# Sample rate Whisper expects (whisper.audio.SAMPLE_RATE); whisper itself is only imported when the model is loaded
+SAMPLE_RATE = 16000
+
+def load_whisper_model():
+    import whisper
+    model = whisper.load_model(WHISPER_MODEL).to(device)
+    if device == "cpu" and INFERENCE_MODE in ("int8", "bf16"):
+        # whisper's Linear subclass only casts its weights to the input dtype; dynamic quantization swaps exact
+        # nn.Linear modules only, so turn them into plain ones first. Its decoding always feeds fp16/fp32 inputs, hence no bf16.
+        for module in model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+    return optimize_model(model, device, allow_bf16=False)
+
+registry.register("whisper", load_whisper_model)
 # Smodel.to(device)
 
-def download_audio(url, output_file, max_duration=100):
+# Number of videos analyzed in parallel, each in its own worker process
+VIDEO_WORKERS = int(os.getenv("VIDEO_WORKERS", 2))
+video_pool = None
+
+MAX_DURATION = 100
+# Model version tags stored with every cached video. Bump one when its model or prompt changes:
+# that stage and every stage after it are recomputed, while the earlier ones are reused. The inference mode is part
+# of the local model tags, so int8 or bf16 outputs are never served after switching back to fp32, or the reverse.
+TRANSCRIPT_TAG = f"whisper-{WHISPER_MODEL}:{INFERENCE_MODE}:{MAX_DURATION}s"
+SUMMARY_TAG = f"{fb}:{INFERENCE_MODE}"
+VERDICT_TAG = f"{GEMINI_MODEL}:video_verdict"
+video_cache = TwoTierCache("videos", max_entries=1000)
+
+def decode_audio(source, max_duration=MAX_DURATION, stdin=None):
+    """
+    Decodes at most `max_duration` seconds of audio into the 16 kHz mono float32 samples Whisper expects.
+    Parameters:
+    source (str): A local media file, or "pipe:0" to read the media from `stdin`.
+    max_duration (int, optional): The maximum duration of the audio to decode in seconds. Defaults to 100 seconds.
+    stdin (file, optional): The stream to read from when `source` is "pipe:0".
+    Returns:
+    numpy.ndarray: The decoded samples, scaled to [-1, 1].
+    Raises:
+    subprocess.CalledProcessError: If ffmpeg cannot decode the media.
+    """
+
+    result = subprocess.run([
+        "ffmpeg", "-loglevel", "error",
+        "-i", source,
+        "-t", str(max_duration),
+        "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+        "-"
+    ], stdin=stdin, stdout=subprocess.PIPE, check=True)
+    return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
+
+@metrics.stage("download_audio")
+def load_audio(url, workspace, max_duration=MAX_DURATION):
     """
-    Downloads audio from a given YouTube URL and saves it as an MP3 file.
+    Gets the metadata and the first `max_duration` seconds of audio of a video in a single yt-dlp run.
+    yt-dlp writes the video's info JSON into the workspace and streams the best audio track to stdout, which is 
+    piped straight into ffmpeg and decoded to raw PCM in memory; nothing is transcoded to MP3 or written to disk.
+    ffmpeg stops reading once it has `max_duration` seconds, and yt-dlp is then stopped.
+    A local media file can be given instead of a URL, in which case it is decoded directly.
     Parameters:
-    url (str): The URL of the YouTube video to download audio from.
-    output_file (str): The path where the downloaded audio file will be saved.
-    max_duration (int, optional): The maximum duration of the audio to download in seconds. Defaults to 100 seconds.
+    url (str): The URL of the YouTube video, or the path of a local media file.
+    workspace (str): The job's working directory.
+    max_duration (int, optional): The maximum duration of the audio to load in seconds. Defaults to 100 seconds.
     Returns:
-    None
+    tuple: The decoded samples (numpy.ndarray) and the video info (dict, empty for local files).
     """
 
     print("- Downloading audio...")
     # subprocess.run(["echo", "- Downloading audio..."])
-    result = subprocess.run(
-        ["yt-dlp", "--skip-download", "--print-json", url],
-        stdout=subprocess.PIPE, text=True
-    )
-    video_info = json.loads(result.stdout)
-    duration = video_info["duration"]  
-    download_duration = min(max_duration, duration)
-    subprocess.run([
+    if os.path.isfile(url):
+        return decode_audio(url, max_duration), {}
+    info_file = os.path.join(workspace, "info.json")
+    downloader = subprocess.Popen([
         "yt-dlp", url,
-        "-x", "--audio-format", "mp3",
-        f"--postprocessor-args=-ss 00:00:00 -t {download_duration}",
-        "-o", output_file
-    ])
+        "-f", "bestaudio/best",
+        "--quiet", "--no-progress", "--no-simulate",
+        "--print-to-file", "%()j", info_file,
+        "-o", "-"
+    ], stdout=subprocess.PIPE)
+    try:
+        audio = decode_audio("pipe:0", max_duration, stdin=downloader.stdout)
+    finally:
+        downloader.stdout.close()
+        if downloader.poll() is None:
+            downloader.kill()
+        downloader.wait()
+    video_info = {}
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            video_info = json.loads(f.readline())
+    duration = video_info.get("duration")
+    if duration is not None:
+        print(f"- Loaded {min(max_duration, duration)} of {duration} seconds of audio")
+    return audio, video_info
 
+@metrics.stage("transcribe")
 def transcribe_audio(audio_file):
     """
-    Transcribes the given audio file into text.
+    Transcribes the given audio into text.
     Args:
-        audio_file (str): The path to the audio file to be transcribed.
+        audio_file (str or numpy.ndarray): The path to the audio file, or 16 kHz mono samples as returned by `load_audio`.
     Returns:
         str: The transcribed text from the audio file.
     """
@@ -56,7 +133,7 @@ def transcribe_audio(audio_file):
     # start_time = time.time()
     print("- Transcribing audio...")
     # subprocess.run(["echo", "- Transcribing audio..."])
-    result = model.transcribe(audio_file)
+    result = registry.get("whisper").transcribe(audio_file)
     # end_time = time.time()
     # time_taken = end_time - start_time
     # print(f"Transcribed text: {result["text"]}")
@@ -79,15 +156,30 @@ def summarize_text(text):
     summarized = summarize(text)
     return summarized
 
+def cached_video_verdict(url):
+    """
+    Returns the cached verdict of a video if every stage of it was produced by the current models, otherwise None.
+    """
+
+    entry = video_cache.get(normalize_video_id(url) or url)
+    if entry and (entry.get("transcript_tag"), entry.get("summary_tag"), entry.get("verdict_tag")) == (TRANSCRIPT_TAG, SUMMARY_TAG, VERDICT_TAG):
+        return entry["verdict"]
+    return None
+
+@metrics.stage("video")
 def fake_video_news(url):
     """
     Processes a video from a given URL to detect fake news.
     This function performs the following steps:
-    1. Downloads the audio from the video at the specified URL.
-    2. Transcribes the downloaded audio to text.
+    1. Streams the first 100 seconds of the video's audio into memory.
+    2. Transcribes the audio to text.
     3. Summarizes the transcribed text.
     4. Detects whether the summarized text contains fake news.
-    5. Optionally deletes the downloaded audio file after processing.
+    5. Deletes the job's workspace, even if a step fails.
+    Every call works in its own temporary directory, so several videos can be processed at the same time.
+    The transcript, summary and verdict are cached by YouTube video ID together with the version tag of the 
+    model that produced them, so a video seen on another page is not downloaded or analyzed again, and only 
+    the stages whose model changed are recomputed.
     Args:
         url (str): The URL of the video to be processed.
     Returns:
@@ -100,22 +192,93 @@ def fake_video_news(url):
         print(result)
     """
 
+    cached = cached_video_verdict(url)
+    if cached is not None:
+        print(f"- Using cached analysis of video {url}")
+        return cached
+    key = normalize_video_id(url) or url
+    entry = video_cache.get(key) or {}
+
     print("- Processing video...")
     start_time = time.time()
-    output_file = "./audio.mp3"
-    delete_after_process = True 
-
-    download_audio(url, output_file)
-    transcript = transcribe_audio(output_file)
-    summary = summarize_text(transcript)
-    result = fake_video_detector(summary)
-
-    if delete_after_process and os.path.exists(output_file):
-        os.remove(output_file)
-        print(f"File {output_file} has been deleted.")
+    if entry.get("transcript_tag") != TRANSCRIPT_TAG:
+        with tempfile.TemporaryDirectory(prefix="video-") as workspace:
+            audio, _ = load_audio(url, workspace)
+            entry = {"transcript": transcribe_audio(audio), "transcript_tag": TRANSCRIPT_TAG}
+        print(f"Workspace {workspace} has been deleted.")
+    if entry.get("summary_tag") != SUMMARY_TAG:
+        entry.update(summary=summarize_text(entry["transcript"]), summary_tag=SUMMARY_TAG, verdict_tag=None)
+    if entry.get("verdict_tag") != VERDICT_TAG:
+        entry.update(verdict=fake_video_detector(entry["summary"]), verdict_tag=VERDICT_TAG)
+    video_cache.set(key, entry)
+    result = entry["verdict"]
 
     end_time = time.time()
     time_taken = end_time - start_time
     print(f"Time taken to analyze: {time_taken:.2f} seconds")
     return result
 
+def fake_video_news_job(url, trace_context=None):
+    """
+    Runs `fake_video_news` in a worker process, as part of the parent's trace, and returns its result with the
+    metrics and spans it recorded, to be applied in the parent with `metrics.replay` and `tracing.replay`.
+    """
+
+    with tracing.attach(trace_context), metrics.capture() as events, tracing.capture() as spans:
+        try:
+            result = fake_video_news(url)
+        except Exception as e:
+            # Keep the spans of the failed analysis
+            return e, events, spans
+    return result, events, spans
+
+def init_video_worker():
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // VIDEO_WORKERS))
+
+def iter_videos_news(urls):
+    """
+    Runs `fake_video_news` for several videos in parallel and yields each result as soon as it is available.
+    Cached videos are answered first; the others are spread over a pool of `VIDEO_WORKERS` processes, created 
+    on first use and kept for later calls, so a page with several embeds takes about as long as its longest video.
+    Workers are spawned rather than forked and split the CPU threads between them. A URL listed several times is 
+    analyzed once.
+    Args:
+        urls (list): The URLs of the videos to be processed.
+    Yields:
+        tuple: `(index, result)` for every position in `urls`, in completion order.
+    Raises:
+        Exception: If any of the processing steps fail for one of the videos.
+    """
+
+    global video_pool
+    positions = {}
+    for i, url in enumerate(urls):
+        positions.setdefault(url, []).append(i)
+    pending = []
+    for url, indices in positions.items():
+        result = cached_video_verdict(url)
+        if result is None:
+            pending.append(url)
+            continue
+        for i in indices:
+            yield i, result
+    if len(pending) == 1:
+        result = fake_video_news(pending[0])
+        for i in positions[pending[0]]:
+            yield i, result
+    elif pending:
+        if video_pool is None:
+            video_pool = ProcessPoolExecutor(
+                max_workers=VIDEO_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_video_worker,
+            )
+        futures = {video_pool.submit(fake_video_news_job, url, tracing.current()): url for url in pending}
+        for future in as_completed(futures):
+            result, events, spans = future.result()
+            metrics.replay(events)
+            tracing.replay(spans)
+            if isinstance(result, Exception):
+                raise result
+            for i in positions[futures[future]]:
+                yield i, result
@@ -1,6 +1,11 @@
+import re
 import requests
 # import subprocess
 from bs4 import BeautifulSoup
+from page_context import get_page
+from urllib.parse import urlsplit, parse_qs
+
+YOUTUBE_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
 
 
 def extract_youtube_links(html_content):
@@ -35,14 +40,54 @@ def extract_youtube_links(html_content):
 
     return youtube_links
 
-def get_youtube_links_from_url(url):
+def filter_youtube_links(iframe_sources):
+    """
+    Keeps the embedded YouTube video links among the given <iframe> sources.
+    Args:
+        iframe_sources (list): The `src` attributes of a page's <iframe> elements.
+    Returns:
+        list: A list of YouTube video URLs.
+    """
+
+    return [src for src in iframe_sources if 'youtube.com/embed/' in src]
+
+def normalize_video_id(url):
+    """
+    Extracts the canonical YouTube video ID from a video URL.
+    Handles embed URLs (including youtube-nocookie.com), watch, shorts and youtu.be links, with or without 
+    a scheme and query string.
+    Args:
+        url (str): The YouTube video URL.
+    Returns:
+        str or None: The 11-character video ID, or None if the URL is not a recognized YouTube video URL.
+    Example:
+        normalize_video_id("https://www.youtube.com/embed/dQw4w9WgXcQ?si=abc")  # Output: 'dQw4w9WgXcQ'
+    """
+
+    parts = urlsplit(url if '//' in url else f'//{url}')
+    host = parts.netloc.lower().split(':')[0]
+    segments = [segment for segment in parts.path.split('/') if segment]
+    candidate = None
+    if host == 'youtu.be' and segments:
+        candidate = segments[0]
+    elif host in ('youtube.com', 'youtube-nocookie.com') or host.endswith(('.youtube.com', '.youtube-nocookie.com')):
+        if len(segments) >= 2 and segments[0] in ('embed', 'shorts', 'v', 'live'):
+            candidate = segments[1]
+        elif segments[:1] == ['watch']:
+            candidate = parse_qs(parts.query).get('v', [None])[0]
+    if candidate and candidate != 'videoseries' and YOUTUBE_ID.match(candidate):
+        return candidate
+    return None
+
+def get_youtube_links_from_url(url, page=None):
     """
     Retrieves YouTube links from the given URL.
-    This function sends a GET request to the specified URL, retrieves the content,
-    and extracts YouTube links from the response text. If the request fails, it raises
+    This function takes the page from the given PageContext, or retrieves it with `get_page`,
+    and extracts YouTube links from its embedded videos. If the request fails, it raises
     a ValueError.
     Args:
         url (str): The URL from which to retrieve content.
+        page (PageContext, optional): The already fetched page to use.
     Returns:
         list: A list of YouTube links extracted from the URL content.
     Raises:
@@ -51,9 +96,10 @@ def get_youtube_links_from_url(url):
 
     print("- Retrieving content from URL...")
     # subprocess.run(["echo", "- Retrieving content from URL..."])
-    response = requests.get(url)
-    if response.status_code == 200:
-        youtube_links = extract_youtube_links(response.text)
-        return youtube_links
-    else:
-        raise ValueError(f"Failed to retrieve content from URL: {url}")
\ No newline at end of file
+    if page is None:
+        try:
+            page = get_page(url)
+        except requests.exceptions.RequestException:
+            raise ValueError(f"Failed to retrieve content from URL: {url}")
+    print("- Extracting YouTube links...")
+    return filter_youtube_links(page.iframe_sources)
\ No newline at end of file